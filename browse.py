@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from driver import DEFAULT_BATCH_SIZE
+from timing import QueryTiming
+
+
+class PagedResult:
+    """
+    Rows of a table read one page at a time, each page being its own query.
+
+    With key columns, pages use keyset pagination (`WHERE (keys) > (last
+    keys) ORDER BY keys LIMIT n`), so reading a page deep in the table costs
+    the same as reading the first one. Without keys, pages fall back to
+    LIMIT / OFFSET, ordered by every column so that the pages neither
+    overlap nor skip rows. The next page is read in the background while
+    the current one is shown.
+
+    With `reverse`, the table is read from its end in descending order, so
+    that showing the last rows does not read (or count) the ones before them.
+    """
+
+    def __init__(self, conn, table, keys=None, keys_query=None, page_size=DEFAULT_BATCH_SIZE, reverse=False):
+        self.connection = conn
+        self.table = table
+        self.page_size = page_size
+        self.reverse = reverse
+        self.query = 'SELECT * FROM ' + table
+        self.rowcount = -1
+        self.fetched = 0
+        self.closed = False
+        self.timing = QueryTiming(self.query)
+
+        # own session: pages are read while the tree uses the connection
+        with self.timing.measure('connect'):
+            self.session = conn.clone()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqltui-browse')
+
+        if keys is None:
+            keys = [row[0] for row in self.session.execute(keys_query)[0]] if keys_query else []
+        self.keys = keys
+        self.last_key = None
+        self.more = True
+        self.position = 0
+        # without keys, pages are ordered by the positions of all the columns
+        self.column_count = 0 if keys else len(self.session.execute(self.query + ' LIMIT 0')[1])
+
+        with self.timing.measure('execute'):
+            self.pending, self.columns = self.read_page()
+        self.type_codes = [None] * len(self.columns)
+        self.next = self.executor.submit(self.read) if self.more else None
+
+    @property
+    def has_more(self):
+        return self.pending is not None or self.next is not None
+
+    def page_query(self):
+        limit = ' LIMIT {}'.format(self.page_size)
+        if self.keys:
+            escaped = [self.connection.escape('id', key) for key in self.keys]
+            keys = ', '.join(escaped)
+            order = ' DESC' if self.reverse else ''
+            query = self.query
+            params = None
+            if self.last_key is not None:
+                query += ' WHERE ({}) {} ({})'.format(keys, '<' if self.reverse else '>',
+                                                      ', '.join(['%s'] * len(self.keys)))
+                params = self.last_key
+            order_by = ', '.join(key + order for key in escaped)
+            return query + ' ORDER BY ' + order_by + limit, params
+
+        order = ' DESC' if self.reverse else ''
+        order_by = ', '.join(str(i) + order for i in range(1, self.column_count + 1))
+        query = self.query + ' ORDER BY ' + order_by if order_by else self.query
+        return query + limit + ' OFFSET {}'.format(self.position), None
+
+    def read_page(self):
+        query, params = self.page_query()
+        rows, columns = self.session.execute(query, params=params)
+        rows = list(rows)
+
+        if self.keys:
+            if rows:
+                indexes = [columns.index(key) for key in self.keys]
+                self.last_key = tuple(rows[-1][i] for i in indexes)
+        else:
+            self.position += len(rows)
+        self.more = len(rows) == self.page_size
+        return rows, columns
+
+    def read(self):
+        with self.timing.measure('fetch'):
+            return self.read_page()[0]
+
+    def fetch(self):
+        if self.pending is not None:
+            batch = self.pending
+            self.pending = None
+        elif self.next is not None and not self.closed:
+            batch = self.next.result()
+            self.next = self.executor.submit(self.read) if self.more and not self.closed else None
+        else:
+            batch = []
+        self.fetched += len(batch)
+        return batch
+
+    def head(self):
+        """ The same table read from its first row. """
+        return PagedResult(self.connection, self.table, self.keys, page_size=self.page_size)
+
+    def tail(self):
+        """ The same table read from its last row. """
+        return PagedResult(self.connection, self.table, self.keys, page_size=self.page_size, reverse=True)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending = None
+        self.next = None
+        # after the page being read, if any
+        self.executor.submit(self.session.close)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,162 @@
+import re
+import sys
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+from driver import WRITE_WORDS, is_row_query
+
+# memory used by all the cached results, and by one of them at most
+RESULT_CACHE_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_ENTRY_BYTES = RESULT_CACHE_BYTES // 4
+# seconds a result stays valid, unless `cache_ttl` is set for the server (0 disables the cache)
+RESULT_CACHE_TTL = 300
+
+TOKENS = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`)|(--[^\n]*|/\*.*?\*/)|(\s+)", re.S)
+# functions whose result changes from one call to the next (or that have side effects)
+VOLATILE_WORDS = (r'now|current_(?:date|time|timestamp)|localtime(?:stamp)?|(?:clock|statement|transaction)_timestamp'
+                  r'|timeofday|random|setseed|gen_random_uuid|uuid_generate_\w+|pg_sleep\w*|pg_advisory\w*'
+                  r'|txid_current|rand|uuid(?:_short)?|sysdate|sleep|cur(?:date|time)|unix_timestamp'
+                  r'|utc_(?:date|time|timestamp)|last_insert_id|found_rows|get_lock|release_lock')
+NOT_READ_ONLY = re.compile(r'\b(' + WRITE_WORDS + r'|lock|nextval|setval|' + VOLATILE_WORDS + r')\b', re.I)
+
+
+def normalize_query(query):
+    """ Query without comments, its whitespace collapsed outside of strings and quoted names. """
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        return ' '
+
+    # twice: comments leave spaces next to the whitespace around them
+    return TOKENS.sub(replace, TOKENS.sub(replace, query)).strip().rstrip(';').strip()
+
+
+def is_read_only(query):
+    """ A single SELECT (or WITH, VALUES, TABLE) that neither writes nor locks rows. """
+    if not is_row_query(query):
+        return False
+    # ignore the content of strings
+    code = TOKENS.sub(lambda match: ' ' if match.group(1) or match.group(2) else match.group(0), query)
+    return NOT_READ_ONLY.search(code) is None
+
+
+def row_size(row):
+    return sys.getsizeof(row) + sum(sys.getsizeof(cell) for cell in row)
+
+
+class CacheEntry:
+
+    def __init__(self, columns, rows, size):
+        self.columns = columns
+        self.rows = rows
+        self.size = size
+        self.created = time()
+
+    def age(self):
+        return time() - self.created
+
+
+class ResultCache:
+    """
+    Results of read-only queries, by (server, user, database, normalized query).
+    Least recently used entries are evicted past the byte budget, and
+    entries older than the TTL of their server are dropped when read.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, max_entry_bytes=RESULT_CACHE_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def ttl(conn):
+        value = conn.options.get('cache_ttl')
+        return RESULT_CACHE_TTL if value is None else float(value)
+
+    @staticmethod
+    def session(conn):
+        """ Server, user and database of `conn`: users of a server may not see the same rows. """
+        return conn.name(), conn.dsn.get('user'), conn.dsn.get('database')
+
+    def key(self, conn, query):
+        return self.session(conn) + (normalize_query(query),)
+
+    def enabled(self, conn, query):
+        return self.ttl(conn) > 0 and is_read_only(query)
+
+    def get(self, conn, query):
+        key = self.key(conn, query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.age() > self.ttl(conn):
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, columns, rows, size):
+        if size > self.max_entry_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = CacheEntry(columns, rows, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        self.size -= self.entries.pop(key).size
+
+    def invalidate(self, conn):
+        """ Drop the results of the server and database of `conn` (something was written). """
+        server, _, database = self.session(conn)
+        with self.lock:
+            # whatever the user that read them
+            for key in [key for key in self.entries if key[0] == server and key[2] == database]:
+                self.remove(key)
+
+    def recording(self, result, conn, query):
+        return RecordingResult(self, self.key(conn, query), result)
+
+
+class RecordingResult:
+    """
+    A ResultSet whose rows are kept while they are fetched, and cached once
+    the whole result was read (unless it got too big to be cached).
+    """
+
+    def __init__(self, cache, key, result):
+        self.cache = cache
+        self.key = key
+        self.result = result
+        self.rows = []
+        self.size = 0
+        self.store_if_complete()
+
+    def __getattr__(self, name):
+        return getattr(self.result, name)
+
+    def fetch(self):
+        batch = self.result.fetch()
+        if self.rows is not None:
+            self.rows.extend(batch)
+            self.size += sum(row_size(row) for row in batch)
+            if self.size > self.cache.max_entry_bytes:
+                self.rows = None
+            self.store_if_complete()
+        return batch
+
+    def store_if_complete(self):
+        result = self.result
+        if self.rows is not None and result.complete and result.pending is None and result.columns:
+            self.cache.put(self.key, list(result.columns), self.rows, self.size)
+            self.rows = None
+
+
+RESULT_CACHE = ResultCache()
@@ -0,0 +1,139 @@
+import json
+import os
+import re
+import sqlite3
+from threading import Lock
+from time import time
+
+# seconds the children of a tree node are reused, unless `tree_cache_ttl` is set for the server (0 disables it)
+TREE_CACHE_TTL = 300
+# snapshots of the catalog of each server, read at startup
+CATALOG_DIR = os.environ.get('SQLTUI_CATALOG_DIR') or os.path.join(os.path.expanduser('~'), '.sqltui', 'catalog')
+
+DDL = re.compile(r'^(create|alter|drop|rename|comment)\b', re.I)
+
+
+def is_ddl(conn, query):
+    """ Whether a statement of `query` changes the catalog. """
+    for statement in conn.split(query):
+        statement = re.sub(r'(--[^\n]*|/\*.*?\*/)', ' ', statement, flags=re.S).strip()
+        if DDL.match(statement):
+            return True
+    return False
+
+
+class CatalogSnapshot:
+    """ Children rows and open nodes of the tree of one server, in a SQLite file. """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            'CREATE TABLE IF NOT EXISTS children (path TEXT PRIMARY KEY, fetched REAL NOT NULL, rows TEXT NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS open_nodes (path TEXT PRIMARY KEY);')
+
+    def load(self):
+        for path, fetched, rows in self.db.execute('SELECT path, fetched, rows FROM children'):
+            yield decode_path(path), fetched, [tuple(row) for row in json.loads(rows)]
+
+    def save(self, entries, fetched):
+        self.db.executemany('INSERT OR REPLACE INTO children VALUES (?, ?, ?)',
+                            [(json.dumps(path), fetched, json.dumps(rows, default=str)) for path, rows in entries])
+        self.db.commit()
+
+    def delete(self, path):
+        self.db.execute('DELETE FROM children WHERE path = ?', (json.dumps(path),))
+        self.db.commit()
+
+    def open_paths(self):
+        return {decode_path(path) for path, in self.db.execute('SELECT path FROM open_nodes')}
+
+    def save_open_paths(self, paths):
+        self.db.execute('DELETE FROM open_nodes')
+        self.db.executemany('INSERT INTO open_nodes VALUES (?)', [(json.dumps(path),) for path in paths])
+        self.db.commit()
+
+
+def decode_path(text):
+    return tuple(tuple(part) for part in json.loads(text))
+
+
+class CatalogCache:
+    """
+    Rows of the children queries of the tree, by path of their node, so that
+    refreshing a node does not query the catalog again before the TTL of its
+    server, unless its subtree was invalidated.
+    Every entry is also written to the snapshot of its server, read back by
+    the next start of the application.
+    """
+
+    def __init__(self, directory=CATALOG_DIR):
+        self.directory = directory
+        self.entries = {}
+        self.snapshots = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def ttl(dsn):
+        value = dsn.get('tree_cache_ttl')
+        return TREE_CACHE_TTL if value is None else float(value)
+
+    def snapshot(self, path):
+        """ Snapshot of the server of `path` (its first part), None when it can't be written. """
+        # Root.key(): driver, user, host, port and database
+        server = path[0][1]
+        if server not in self.snapshots:
+            name = re.sub(r'[^\w.]+', '-', server).strip('-') + '.sqlite'
+            try:
+                self.snapshots[server] = CatalogSnapshot(os.path.join(self.directory, name))
+            except (OSError, sqlite3.Error):
+                self.snapshots[server] = None
+        return self.snapshots[server]
+
+    def load(self, root_path):
+        """ Read the snapshot of a server, returns the paths of the nodes that were open. """
+        snapshot = self.snapshot(root_path)
+        if snapshot is None:
+            return set()
+        with self.lock:
+            for path, fetched, rows in snapshot.load():
+                self.entries.setdefault(path, (fetched, rows))
+            return snapshot.open_paths()
+
+    def save_open_paths(self, root_path, paths):
+        snapshot = self.snapshot(root_path)
+        if snapshot is not None:
+            with self.lock:
+                snapshot.save_open_paths(paths)
+
+    def get(self, path, ttl=None):
+        """ Cached rows, None when missing or older than `ttl` (any age when None). """
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or (ttl is not None and time() - entry[0] > ttl):
+                return None
+            return entry[1]
+
+    def put(self, path, rows):
+        self.put_many([(path, rows)])
+
+    def put_many(self, entries):
+        """ Store (path, rows) entries of the same server at once. """
+        if not entries:
+            return
+        snapshot = self.snapshot(entries[0][0])
+        fetched = time()
+        with self.lock:
+            for path, rows in entries:
+                self.entries[path] = (fetched, rows)
+            if snapshot is not None:
+                snapshot.save(entries, fetched)
+
+    def remove(self, path):
+        snapshot = self.snapshot(path)
+        with self.lock:
+            if self.entries.pop(path, None) is not None and snapshot is not None:
+                snapshot.delete(path)
+
+
+CATALOG_CACHE = CatalogCache()
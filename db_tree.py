@@ -7,11 +7,20 @@ from prompt_toolkit.keys import Keys
 
 from dialogs import buttons_dialog
 from driver import DRIVERS
+from browse import PagedResult
+from catalog import CATALOG_CACHE, is_ddl
+from export import export_dialog
+from importer import import_dialog
 from keys import CustomKeyBindings
+from metrics import REGISTRY
+from runner import RowsResult, count_rows
 from script import findScripts
 from tree import FILE_ITEM_LEAF
 from tree import Tree, FILE_ITEM_NODE
 from tree import TreeItem
+from indexing import INDEX_WORKERS
+from watcher import SchemaWatcher
+from worker import run_in_background
 
 servers = toml.load('config/servers.toml')['servers']
 
@@ -24,6 +33,11 @@ class Root:
     def __str__(self):
         return self.driver.name + ' <' + self.dsn['host'] + ':' + self.dsn['port'] + '>'
 
+    def key(self):
+        """ Name of the server in the catalog cache: servers on the same host may differ by user or database. """
+        return '{} <{}@{}:{}/{}>'.format(self.driver.name, self.dsn.get('user', ''), self.dsn['host'],
+                                         self.dsn['port'], self.dsn.get('database', ''))
+
 
 def replace_query(conn, query, parents):
     matched_strings = [m.group(1) for m in re.finditer('#{([^}]*?)}', query)]
@@ -60,12 +74,72 @@ class DbTreeItem(TreeItem):
 
     def execute(self, tab_name, conn_type, query):
         def after():
-            self.parents[conn_type].refresh()
-
-        conn = self.connections[conn_type]
+            # reading or writing rows leaves the tree as it is
+            if not is_ddl(conn, query):
+                return
+            # this node may have been renamed or dropped: its parent lists its children again
+            node = self.parent or self
+            node.invalidate(recursive=False)
+            self.invalidate()
+            node.refresh()
+
+        conn = self.get_connection(conn_type)
         replacedQuery = replace_query(conn, query, self.parents)
         self.tree.execute(tab_name, conn, replacedQuery, after)
 
+    def export(self):
+        conn_type, query = self.node_data['export']
+        conn = self.get_connection(conn_type)
+        export_dialog(conn, replace_query(conn, query, self.parents), 'Export ' + self.name)
+
+    def browse(self):
+        conn_type, table, keys_query = self.node_data['browse']
+        conn = self.get_connection(conn_type)
+        table = replace_query(conn, table, self.parents)
+        keys_query = replace_query(conn, keys_query, self.parents)
+        self.tree.open_result(self.name, conn, 'SELECT * FROM ' + table + ';',
+                              open_result=lambda: PagedResult(conn, table, keys_query=keys_query))
+
+    def exact_counts(self):
+        """ Count the rows of each child table in parallel, the counts are shown in the result panel. """
+        conn_type = self.getRoot().driver.nodes[self.node_data['children_type']]['count'][0]
+        conn = self.get_connection(conn_type)
+        owner = self.parents[conn_type]
+
+        def table_scripts(conn, children):
+            tables = [item for item in children if isinstance(item, DbTreeItem) and 'count' in item.node_data]
+            return [(str(item.data[0]), conn.split(replace_query(conn, item.node_data['count'][1], item.parents)))
+                    for item in tables]
+
+        if self.children:
+            scripts = table_scripts(conn, self.children)
+            if not scripts:
+                return
+            query = '\n'.join(';\n'.join(statements) + ';' for _, statements in scripts)
+        else:
+            # the tables are listed by the background job, not on the UI thread
+            scripts = None
+            query = '-- Exact counts of the tables of {}'.format(self.name)
+
+        def count():
+            table_list = scripts
+            if table_list is None:
+                listing = self.index_owner().new_connection()
+                try:
+                    table_list = table_scripts(listing, self.create_children(self.fetch_children(listing)))
+                finally:
+                    listing.close()
+            rows = count_rows(owner.new_connection, table_list, self.index_workers())
+            return RowsResult(['Table', 'Rows', 'Time (ms)', 'Error'], rows, conn, None,
+                              'Exact counts of {} tables -'.format(len(rows)))
+
+        self.tree.open_result('Counts ' + self.name, conn, query, open_result=count)
+
+    def bulk_import(self):
+        conn_type, table = self.node_data['import']
+        conn = self.get_connection(conn_type)
+        import_dialog(conn, replace_query(conn, table, self.parents), 'Import into ' + self.name)
+
     def create_button(self, button):
         def visit_callback(indexing=False):
             if not indexing:
@@ -75,13 +149,35 @@ class DbTreeItem(TreeItem):
 
     def get_connection(self, type):
         if type not in self.connections:
-            conn = self.getRoot().driver.open_connection(type, self.parents)
+            owner = self.parents.get(type)
+            if isinstance(owner, DbTreeItem) and owner is not self:
+                # one connection per server or database, shared by the nodes below it
+                conn = owner.get_connection(type)
+            else:
+                conn = self.getRoot().driver.open_connection(type, self.parents)
             self.connections[type] = conn
         else:
             conn = self.connections[type]
         return conn
 
     def visit_callback(self, indexing=False):
+        rows = None
+        if 'children_query' in self.node_data:
+            path = self.path()
+            # while the tree is restored, the snapshot is used whatever its age (revalidated afterwards)
+            rows = CATALOG_CACHE.get(path, None if self.tree.restoring else self.cache_ttl())
+            if rows is None:
+                try:
+                    rows = self.fetch_children()
+                except Exception:
+                    # unreachable server: browse its last snapshot
+                    rows = CATALOG_CACHE.get(path)
+                    if rows is None:
+                        raise
+        return self.create_children(rows)
+
+    def create_children(self, rows):
+        """ Items of the children, from the rows of the children query. """
         children = []
         if 'children_array' in self.node_data:
             array = self.node_data['children_array']
@@ -90,12 +186,7 @@ class DbTreeItem(TreeItem):
                     DbTreeItem(self.tree, self, row[0], self.connections.copy(), (row[1],),
                                self.parents.copy()))
         else:
-            query_data = self.node_data['children_query']
-            conn = self.get_connection(query_data[0])
-            query = replace_query(conn, query_data[1], self.parents)
-            result = [row for row in conn.execute(query)[0]]
-
-            for r in result:
+            for r in rows:
                 children.append(
                     DbTreeItem(self.tree, self, self.node_data['children_type'], self.connections.copy(), r,
                                self.parents.copy()))
@@ -105,6 +196,113 @@ class DbTreeItem(TreeItem):
                 children.append(self.create_button(button))
         return children
 
+    def cache_ttl(self):
+        return CATALOG_CACHE.ttl(self.getRoot().dsn)
+
+    def cached_children(self, stale=False):
+        """ Rows of the children when they can be read without querying (None otherwise). """
+        if 'children_query' not in self.node_data:
+            return []
+        return CATALOG_CACHE.get(self.path(), None if stale else self.cache_ttl())
+
+    def fetch_children(self, conn=None):
+        """ Rows of the children from the cache, else queried (with the siblings when possible). """
+        rows = self.cached_children()
+        if rows is None:
+            if 'children_bulk_query' in self.node_data and self.missing_siblings(self.cache_ttl()):
+                rows = self.query_with_siblings(conn)
+            else:
+                rows = self.query_children(conn)
+        return rows
+
+    def index_owner(self):
+        """ Node owning the connection that queries the children. """
+        return self.parents[self.node_data['children_query'][0]]
+
+    def index_workers(self):
+        return int(self.getRoot().dsn.get('index_workers', INDEX_WORKERS))
+
+    def new_connection(self):
+        """ A connection of the type of this node, not shared with the tree (for background work). """
+        return self.getRoot().driver.open_connection(self.key, self.parents)
+
+    def query_children(self, conn=None):
+        conn_type, query = self.node_data['children_query']
+        conn = conn or self.get_connection(conn_type)
+        rows = [row for row in conn.execute(replace_query(conn, query, self.parents))[0]]
+        CATALOG_CACHE.put(self.path(), rows)
+        return rows
+
+    def missing_siblings(self, ttl):
+        """ Nodes of the same type next to this one, whose children are not cached. """
+        if self.parent is None:
+            return []
+        return [item for item in self.parent.children
+                if item is not self and isinstance(item, DbTreeItem) and item.key == self.key
+                and CATALOG_CACHE.get(item.path(), ttl) is None]
+
+    def query_with_siblings(self, conn=None):
+        """
+        Children of this node and of its siblings of the same type, read at once
+        with the `children_bulk_query` (rows of sibling name, then child row).
+        """
+        conn_type, query = self.node_data['children_bulk_query']
+        conn = conn or self.get_connection(conn_type)
+        groups = {}
+        for row in conn.execute(replace_query(conn, query, self.parents))[0]:
+            groups.setdefault(str(row[0]), []).append(tuple(row[1:]))
+
+        siblings = [item for item in self.parent.children if isinstance(item, DbTreeItem) and item.key == self.key]
+        CATALOG_CACHE.put_many([(item.path(), groups.get(str(item.data[0]), [])) for item in siblings])
+        REGISTRY.inc('tree_bulk_queries', server=conn.name())
+        return groups.get(str(self.data[0]), [])
+
+    def query_fingerprint(self, conn):
+        """ Fingerprint of each child, by name. """
+        conn_type, query = self.node_data['fingerprint']
+        return {str(row[0]): tuple(row[1:]) for row in conn.execute(replace_query(conn, query, self.parents))[0]}
+
+    def reload(self):
+        """ Show the children queried again: now when open, else when opened. """
+        if self.isOpen:
+            self.refresh()
+        else:
+            self.set_children([])
+
+    def restore(self, open_paths):
+        """ Open again the nodes open in the snapshot, when their children are cached. """
+        path = self.path()
+        if path not in open_paths or self.visit_callback is None:
+            return
+        if 'children_query' in self.node_data and CATALOG_CACHE.get(path) is None:
+            return
+        if not self.children:
+            self.set_children(self.visit_callback())
+        self.isOpen = True
+        for child in self.children:
+            if isinstance(child, DbTreeItem):
+                child.restore(open_paths)
+
+    def path(self):
+        """ Node types and names from the server to this node. """
+        path = []
+        item = self
+        while isinstance(item, DbTreeItem):
+            name = item.data[0] if isinstance(item.data, tuple) else item.data
+            path.append((item.key, name.key() if isinstance(name, Root) else str(name)))
+            item = item.parent
+        return tuple(reversed(path))
+
+    def invalidate(self, recursive=True):
+        """ Query the children of this node (and of its descendants) again on their next refresh. """
+        items = [self]
+        while items:
+            item = items.pop()
+            if isinstance(item, DbTreeItem):
+                CATALOG_CACHE.remove(item.path())
+                if recursive:
+                    items.extend(item.children)
+
     def __init__(self, tree, parent, key, connections, data, parents):
         self.key = key
         self.connections = connections
@@ -131,17 +329,30 @@ class DbTreeItem(TreeItem):
         self.actions = self.node_data['actions'] if 'actions' in self.node_data else []
         self.actions = self.actions + findScripts(self)
 
+        # actions implemented in python: [name, callback]
+        self.tools = []
+        if 'browse' in self.node_data:
+            self.tools.append(['Browse', self.browse])
+        if 'export' in self.node_data:
+            self.tools.append(['Export', self.export])
+        if 'import' in self.node_data:
+            self.tools.append(['Bulk Import', self.bulk_import])
+        if 'count' in self.getRoot().driver.nodes.get(self.node_data.get('children_type'), {}):
+            self.tools.append(['Exact Counts', self.exact_counts])
+
         super().__init__(tree, parent, FILE_ITEM_NODE, [(self.node_data['color'], self.name)], isOpen, callback, None)
 
 
 class DatabaseTree:
 
-    def __init__(self, execute, add_tab):
+    def __init__(self, execute, add_tab, open_result):
         self.execute = execute
 
         self.tree = Tree(self.itemSelected)
         self.tree.execute = execute
         self.tree.add_tab = add_tab
+        self.tree.open_result = open_result
+        self.tree.restoring = False
         self.tree.roots = []
         for server_key in servers:
             self.addServer(servers[server_key])
@@ -157,11 +368,13 @@ class DatabaseTree:
 
         this_has_focus = Condition(lambda: get_app().layout.has_focus(self.tree))
         has_actions = Condition(lambda: get_app().layout.has_focus(self.tree)
+                                        and not self.tree.search_mode
                                         and hasattr(self.tree.cursorItem, 'actions')
-                                        and len(self.tree.cursorItem.actions) > 0)
+                                        and len(self.tree.cursorItem.actions) + len(self.tree.cursorItem.tools) > 0)
 
         can_open = Condition(
             lambda: get_app().layout.has_focus(self.tree)
+                    and not self.tree.search_mode
                     and hasattr(self.tree.cursorItem, 'open_action')
                     and self.tree.cursorItem.open_action)
 
@@ -169,6 +382,8 @@ class DatabaseTree:
         def refresh_action(event):
             selItem = self.tree.cursorItem
             if selItem:
+                if isinstance(selItem, DbTreeItem):
+                    selItem.invalidate()
                 selItem.refresh()
 
         @kb.add('Actions', 'a', 'a', filter=has_actions)
@@ -178,6 +393,7 @@ class DatabaseTree:
             actions = []
             for a in selItem.actions:
                 actions.append([a[0], selItem.create_execute_callback(a[0], a[1], a[2])])
+            actions = actions + selItem.tools
 
             buttons_dialog(
                 'Actions for ' + selItem.name,
@@ -197,6 +413,75 @@ class DatabaseTree:
     def itemSelected(self, item):
         pass
 
+    def start(self):
+        """ Background work, once the application runs. """
+        for root in self.tree.roots:
+            self.revalidate_server(root)
+            SchemaWatcher(root, lambda item, online: self.set_offline(item, not online)).start()
+
+    def revalidate_server(self, server_item):
+        """ Query again, in the background, the nodes restored from a stale snapshot. """
+        ttl = CATALOG_CACHE.ttl(server_item.getRoot().dsn)
+        items = []
+        pending = [server_item]
+        while pending:
+            item = pending.pop(0)
+            if isinstance(item, DbTreeItem) and item.children:
+                if 'children_query' in item.node_data and CATALOG_CACHE.get(item.path(), ttl) is None:
+                    items.append(item)
+                pending.extend(item.children)
+        if not items:
+            return
+        driver = server_item.getRoot().driver
+
+        def run():
+            # connections of this thread only, the tree keeps using its own
+            connections = {}
+            changed = []
+            try:
+                for item in items:
+                    conn_type = item.node_data['children_query'][0]
+                    owner = item.parents[conn_type]
+                    if owner not in connections:
+                        connections[owner] = driver.open_connection(conn_type, item.parents)
+                    old = CATALOG_CACHE.get(item.path())
+                    if item.query_children(connections[owner]) != old:
+                        changed.append(item)
+            finally:
+                for conn in connections.values():
+                    conn.close()
+            return changed
+
+        def done(changed):
+            self.set_offline(server_item, False)
+            for item in changed:
+                item.reload()
+            self.tree.dirty = True
+
+        def error(e):
+            self.set_offline(server_item, True)
+
+        run_in_background(run, done, error)
+
+    def set_offline(self, server_item, offline):
+        if (len(server_item.formattedText) > 1) == offline:
+            return
+        server_item.formattedText = server_item.formattedText[:1] + ([('#777777', ' [offline]')] if offline else [])
+        self.tree.dirty = True
+        get_app().invalidate()
+
+    def save_snapshot(self):
+        """ Remember the open nodes of each server, opened again by the next start. """
+        for root in self.tree.roots:
+            paths = []
+            items = [root]
+            while items:
+                item = items.pop()
+                if isinstance(item, DbTreeItem) and item.isOpen:
+                    paths.append(item.path())
+                    items.extend(item.children)
+            CATALOG_CACHE.save_open_paths(root.path(), paths)
+
     def addServer(self, dsn):
         #
         # driver_name = text.split('://')[0]
@@ -222,7 +507,10 @@ class DatabaseTree:
 
         root = Root(dsn, driver)
 
+        self.tree.restoring = True
         serverItem = DbTreeItem(self.tree, None, driver.root, {}, root, {'__root__': root})
+        serverItem.restore(CATALOG_CACHE.load(serverItem.path()))
+        self.tree.restoring = False
         self.tree.roots.insert(0, serverItem)
         self.tree.cursorItem = serverItem
 
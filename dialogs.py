@@ -132,6 +132,56 @@ def inputs_dialog(callback, title='', subtitle='', inputs_data=[]):
     get_app().invalidate()
 
 
+def text_dialog(title='', text='', close_text='Close'):
+    def return_handle():
+        remove_float(float_dialog)
+        get_app().invalidate()
+
+    close_button = Button(text=close_text, handler=return_handle)
+
+    dialog = CustomDialog(
+        title=title,
+        body=HSplit([Label(text)]),
+        buttons=[close_button],
+        width=D(min=120),
+        with_background=False)
+
+    float_dialog = Float(
+        content=dialog
+    )
+
+    get_app().layout.container.floats.append(float_dialog)
+    get_app().layout.focus(close_button)
+    get_app().invalidate()
+
+
+def progress_dialog(title='', get_text=lambda: '', cancel=None, cancel_text='Cancel'):
+    """ Dialog showing `get_text()` on each render, with an optional cancel button. """
+
+    def cancel_handle():
+        cancel()
+        get_app().invalidate()
+
+    buttons = [Button(text=cancel_text, handler=cancel_handle)] if cancel else None
+
+    dialog = CustomDialog(
+        title=title,
+        body=HSplit([Label(''), Label(get_text), Label('')]),
+        buttons=buttons,
+        width=D(min=120),
+        with_background=False)
+
+    float_dialog = Float(
+        content=dialog
+    )
+
+    get_app().layout.container.floats.append(float_dialog)
+    if buttons:
+        get_app().layout.focus(buttons[0])
+    get_app().invalidate()
+    return float_dialog
+
+
 def loading_dialog(title=''):
     dialog = CustomDialog(
         title=title,
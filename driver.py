@@ -1,9 +1,159 @@
+import re
+from itertools import count
+from threading import Lock
+from time import time
 from os import walk
 from os.path import join
 
 import toml
 from pygments.lexers.sql import MySqlLexer, PostgresLexer
 
+from metrics import timed
+from runner import SCRIPT_ROW_LIMIT, StatementResult, read_statement, run_timed, split_statements
+from timing import QueryTiming
+
+DEFAULT_BATCH_SIZE = 500
+
+# servers.toml keys that configure the tool rather than the driver connection
+SERVER_OPTIONS = ('driver', 'statement_timeout', 'max_execution_time', 'memory_threshold', 'local_infile',
+                  'cache_ttl', 'tree_cache_ttl', 'watch_interval', 'index_workers')
+
+_cursor_ids = count()
+
+
+def server_label(conn, *args, **kwargs):
+    return {'server': conn.name()}
+
+
+# statements of a row query that write or lock rows
+WRITE_WORDS = r'insert|update|delete|merge|into|for\s+(?:update|share|no\s+key\s+update|key\s+share)'
+WRITES = re.compile(r'\b(' + WRITE_WORDS + r')\b', re.I)
+QUOTED_OR_COMMENT = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|--[^\n]*|/\*.*?\*/", re.S)
+
+
+def writes_rows(query):
+    """ Whether a query writes or locks rows (SELECT ... INTO, FOR UPDATE, a CTE with DELETE...). """
+    return WRITES.search(QUOTED_OR_COMMENT.sub(' ', query)) is not None
+
+
+# statements PostgreSQL refuses to run inside a transaction block
+NO_TRANSACTION = re.compile(r'\s*(?:vacuum|(?:create|drop)\s+(?:database|tablespace)|alter\s+system'
+                            r'|(?:create(?:\s+unique)?|drop)\s+index\s+concurrently'
+                            r'|reindex\s+(?:\([^)]*\)\s*)?(?:database|system)|reindex\b.*\bconcurrently)\b', re.I | re.S)
+
+
+def runs_outside_transaction(statement):
+    return NO_TRANSACTION.match(QUOTED_OR_COMMENT.sub(' ', statement)) is not None
+
+
+CALL = re.compile(r'\s*call\b', re.I)
+
+
+def is_call(statement):
+    """ Whether a statement calls a procedure, which may return several results. """
+    return CALL.match(QUOTED_OR_COMMENT.sub(' ', statement)) is not None
+
+
+def is_row_query(query):
+    query = re.sub(r'(--[^\n]*|/\*.*?\*/)', ' ', query, flags=re.S).strip().rstrip(';').strip()
+    if ';' in query:
+        return False
+    first_word = query.split(None, 1)[0].lower() if query else ''
+    return first_word in ('select', 'with', 'values', 'table')
+
+
+class ResultSet:
+    """
+    Rows of a query read lazily, one batch of `fetchmany` at a time.
+
+    The first batch is read as soon as the result is created, so that the
+    column metadata is known (server-side cursors only describe themselves
+    after the first fetch).
+    """
+
+    def __init__(self, cursor, batch_size=DEFAULT_BATCH_SIZE, on_close=None, connection=None, query=None,
+                 timing=None):
+        self.cursor = cursor
+        self.timing = timing or QueryTiming(query)
+        self.connection = connection
+        self.query = query
+        self.batch_size = batch_size
+        self.on_close = on_close
+        self.closed = False
+        self.close_requested = False
+        self.fetched = 0
+        self.lock = Lock()
+
+        # no result set (an UPDATE...): no rows. Named cursors only describe
+        # themselves after their first fetch, which runs the query: its errors are raised
+        if cursor.description is None and getattr(cursor, 'name', None) is None:
+            self.pending = None
+        else:
+            with self.timing.measure('execute'):
+                self.pending = cursor.fetchmany(batch_size)
+
+        description = cursor.description or []
+        self.description = description
+        self.columns = [desc[0] for desc in description]
+        self.type_codes = [desc[1] for desc in description]
+        self.rowcount = cursor.rowcount
+
+        if self.pending is None or len(self.pending) < batch_size:
+            self.has_more = False
+        else:
+            self.has_more = True
+        # every row was read from the server (not closed before the end)
+        self.complete = self.pending is not None and not self.has_more
+
+    def fetch(self):
+        with self.lock:
+            if self.pending is not None:
+                batch = self.pending
+                self.pending = None
+            elif self.has_more and not self.closed:
+                with self.timing.measure('fetch'):
+                    batch = self.cursor.fetchmany(self.batch_size)
+                if len(batch) < self.batch_size:
+                    self.has_more = False
+                    self.complete = True
+            else:
+                batch = []
+            self.fetched += len(batch)
+
+        if self.close_requested or (not self.has_more and self.pending is None):
+            self.close()
+        return batch
+
+    def fetch_all(self):
+        rows = []
+        while self.pending is not None or self.has_more:
+            rows.extend(self.fetch())
+        return rows
+
+    def __iter__(self):
+        while self.pending is not None or self.has_more:
+            yield self.fetch()
+
+    def close(self):
+        # a fetch is running in a worker: it closes the result when done
+        if not self.lock.acquire(blocking=False):
+            self.close_requested = True
+            return
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            self.complete = self.complete and self.pending is None
+            self.has_more = False
+            self.pending = None
+            if self.on_close:
+                self.on_close()
+            self.cursor.close()
+        except Exception:
+            pass
+        finally:
+            self.lock.release()
+
 
 class Connection:
 
@@ -19,9 +169,37 @@ class Connection:
     def connect(self):
         raise NotImplemented('connect not implemented')
 
-    def execute(self, query):
+    def execute(self, query, reconnect=False, params=None):
         raise NotImplemented("execute not implemented")
 
+    def stream(self, query, batch_size=DEFAULT_BATCH_SIZE, timing=None):
+        raise NotImplemented("stream not implemented")
+
+    def split(self, script):
+        return split_statements(script)
+
+    def run_script(self, statements, row_limit=SCRIPT_ROW_LIMIT):
+        raise NotImplemented("run_script not implemented")
+
+    def explain(self, query, analyze=False):
+        raise NotImplemented("explain not implemented")
+
+    def cancel(self):
+        raise NotImplemented("cancel not implemented")
+
+    def clone(self):
+        """ New connection to the same server and database, with its own sessions. """
+        return type(self)(dict(self.dsn, **self.options))
+
+    def insert_many(self, table, columns, rows):
+        raise NotImplemented("insert_many not implemented")
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
     def close(self):
         raise NotImplemented("close not implemented")
 
@@ -46,10 +224,11 @@ class Driver:
 class PsqlConnection(Connection):
 
     def __init__(self, dsn):
-        dsn = dsn.copy()
-        del dsn['driver']
-        self.dsn = dsn
+        self.options = {key: dsn[key] for key in SERVER_OPTIONS if key in dsn}
+        self.dsn = {key: dsn[key] for key in dsn if key not in SERVER_OPTIONS}
         self.conn = None
+        self.stream_conn = None
+        self.result_set = None
         self.connect()
 
     def __str__(self):
@@ -62,15 +241,25 @@ class PsqlConnection(Connection):
     def lexer(self):
         return PostgresLexer
 
-    def connect(self):
+    def open(self):
         import psycopg2
-        self.conn = psycopg2.connect(**self.dsn)
+        conn = psycopg2.connect(**self.dsn)
+        if 'statement_timeout' in self.options:
+            with conn.cursor() as cursor:
+                cursor.execute('SET statement_timeout = %s', (int(self.options['statement_timeout']),))
+            conn.commit()
+        return conn
+
+    @timed('driver_connect', server_label)
+    def connect(self):
+        self.conn = self.open()
 
-    def execute(self, query, reconnect=False):
+    @timed('driver_execute', server_label)
+    def execute(self, query, reconnect=False, params=None):
         conn = self.conn
         try:
             with conn.cursor() as cursor:
-                cursor.execute(query)
+                cursor.execute(query, params)
 
                 result = []
                 columns = []
@@ -91,19 +280,155 @@ class PsqlConnection(Connection):
             if 'cannot run inside a transaction block' in str(e):
                 if not conn.isolation_level or conn.isolation_level > 0:
                     conn.set_isolation_level(0)
-                    final = self.execute(query)
+                    final = self.execute(query, params=params)
                     conn.set_isolation_level(1)
                     return final
             elif not reconnect:
                 try:
                     self.connect()
-                    return self.execute(query, True)
+                    return self.execute(query, True, params)
                 except Exception as e2:
                     raise e
             else:
                 raise e
 
+    def stream(self, query, batch_size=DEFAULT_BATCH_SIZE, reconnect=False, timing=None):
+        timing = timing or QueryTiming(query)
+        if self.result_set:
+            self.result_set.close()
+            self.result_set = None
+
+        if self.stream_conn is None or self.stream_conn.closed:
+            with timing.measure('connect'):
+                self.stream_conn = self.open()
+        conn = self.stream_conn
+
+        try:
+            if is_row_query(query) and not writes_rows(query):
+                # named cursor: rows stay on the server until fetched (DECLARE rejects
+                # or changes the statements that write or lock rows)
+                cursor = conn.cursor(name='sqltui_{}'.format(next(_cursor_ids)))
+                cursor.itersize = batch_size
+            else:
+                cursor = conn.cursor()
+            with timing.measure('execute'):
+                cursor.execute(query)
+        except Exception as e:
+            if not conn.closed and not conn.autocommit:
+                conn.rollback()
+
+            if 'cannot run inside a transaction block' in str(e) and not conn.autocommit:
+                conn.set_isolation_level(0)
+                try:
+                    return self.stream(query, batch_size, reconnect, timing)
+                finally:
+                    conn.set_isolation_level(1)
+            elif not reconnect and conn.closed:
+                self.stream_conn = None
+                return self.stream(query, batch_size, True, timing)
+            raise e
+
+        def on_close():
+            if not conn.closed and not conn.autocommit:
+                conn.commit()
+
+        try:
+            self.result_set = ResultSet(cursor, batch_size, on_close, self, query, timing)
+        except Exception:
+            # the query of a named cursor failed on its first fetch
+            if not conn.closed and not conn.autocommit:
+                conn.rollback()
+            raise
+        if not self.result_set.has_more and self.result_set.pending is None:
+            self.result_set.close()
+        return self.result_set
+
+    def cancel(self):
+        if self.stream_conn is not None and not self.stream_conn.closed:
+            self.stream_conn.cancel()
+
+    def copy_in(self, table, columns, file):
+        """ Load CSV rows (without header) from `file` into `table` using COPY. """
+        sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(table, ', '.join(columns))
+        with self.conn.cursor() as cursor:
+            cursor.copy_expert(sql, file)
+
+    def insert_many(self, table, columns, rows):
+        from psycopg2.extras import execute_values
+        sql = 'INSERT INTO {} ({}) VALUES %s'.format(table, ', '.join(columns))
+        with self.conn.cursor() as cursor:
+            execute_values(cursor, sql, rows, page_size=len(rows))
+
+    def stream_session(self):
+        """ The streaming session, without an open result set. """
+        if self.result_set:
+            self.result_set.close()
+            self.result_set = None
+        if self.stream_conn is None or self.stream_conn.closed:
+            self.stream_conn = self.open()
+        return self.stream_conn
+
+    def run_script(self, statements, row_limit=SCRIPT_ROW_LIMIT):
+        """
+        Run `statements` back to back in one transaction of the streaming
+        session, rolled back at the first error. Statements that cannot run
+        in a transaction (VACUUM, CREATE INDEX CONCURRENTLY...) commit the
+        statements before them and run on their own, in autocommit. Returns
+        their StatementResult.
+        """
+        conn = self.stream_session()
+        results = []
+        with conn.cursor() as cursor:
+            for statement in statements:
+                if runs_outside_transaction(statement):
+                    conn.commit()
+                    conn.set_isolation_level(0)
+                    try:
+                        results.extend(run_timed(cursor, [statement], row_limit))
+                    finally:
+                        conn.set_isolation_level(1)
+                else:
+                    results.extend(run_timed(cursor, [statement], row_limit))
+                if results[-1].error is not None:
+                    break
+        if results and results[-1].error is not None:
+            conn.rollback()
+        else:
+            conn.commit()
+        return results
+
+    def explain(self, query, analyze=False):
+        """
+        ('postgres', JSON plan) of `query`. With `analyze` the query runs, in
+        a transaction rolled back afterwards, on a session of its own.
+        """
+        options = 'FORMAT JSON, ANALYZE, BUFFERS' if analyze else 'FORMAT JSON'
+        session = self.clone()
+        try:
+            with session.conn.cursor() as cursor:
+                cursor.execute('EXPLAIN ({}) {}'.format(options, query.strip().rstrip(';')))
+                plan = cursor.fetchone()[0]
+            session.conn.rollback()
+        finally:
+            session.close()
+        return 'postgres', plan
+
+    def copy_out(self, query, file):
+        """ Write the result of `query` as CSV (with header) to `file` using COPY. """
+        conn = self.stream_session()
+        try:
+            with conn.cursor() as cursor:
+                cursor.copy_expert('COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)'.format(query.strip().rstrip(';')), file)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
     def close(self):
+        if self.result_set:
+            self.result_set.close()
+        if self.stream_conn:
+            self.stream_conn.close()
         self.conn.close()
 
     def escape(self, type, value):
@@ -134,10 +459,11 @@ class PsqlDriver(Driver):
 class MySqlConnection(Connection):
 
     def __init__(self, dsn):
-        dsn = dsn.copy()
-        del dsn['driver']
-        self.dsn = dsn
+        self.options = {key: dsn[key] for key in SERVER_OPTIONS if key in dsn}
+        self.dsn = {key: dsn[key] for key in dsn if key not in SERVER_OPTIONS}
         self.conn = None
+        self.stream_conn = None
+        self.result_set = None
         self.connect()
 
     def __str__(self):
@@ -147,18 +473,30 @@ class MySqlConnection(Connection):
     def lexer(self):
         return MySqlLexer
 
-    def connect(self):
+    def open(self):
         import mysql.connector
-        self.conn = mysql.connector.connect(**self.dsn)
+        dsn = self.dsn
+        if self.options.get('local_infile'):
+            dsn = dict(dsn, allow_local_infile=True)
+        conn = mysql.connector.connect(**dsn)
+        if 'max_execution_time' in self.options:
+            with conn.cursor() as cursor:
+                cursor.execute('SET SESSION max_execution_time = %s', (int(self.options['max_execution_time']),))
+        return conn
+
+    @timed('driver_connect', server_label)
+    def connect(self):
+        self.conn = self.open()
 
     def name(self):
         return self.dsn['host'] + ':' + self.dsn['port']
 
-    def execute(self, query, reconnect=False):
+    @timed('driver_execute', server_label)
+    def execute(self, query, reconnect=False, params=None):
         conn = self.conn
         try:
             with conn.cursor() as cursor:
-                cursor.execute(query)
+                cursor.execute(query, params)
 
                 result = []
                 columns = []
@@ -176,13 +514,199 @@ class MySqlConnection(Connection):
             if not reconnect:
                 try:
                     self.connect()
-                    self.execute(query, True)
+                    return self.execute(query, True, params)
                 except Exception as e2:
                     raise e
             else:
                 raise e
 
+    def stream(self, query, batch_size=DEFAULT_BATCH_SIZE, reconnect=False, timing=None):
+        timing = timing or QueryTiming(query)
+        if self.result_set:
+            self.result_set.close()
+            self.result_set = None
+
+        if self.stream_conn is None or not self.stream_conn.is_connected():
+            with timing.measure('connect'):
+                self.stream_conn = self.open()
+        conn = self.stream_conn
+
+        try:
+            # unbuffered: rows are read from the socket as they are fetched
+            cursor = conn.cursor(buffered=False)
+            with timing.measure('execute'):
+                cursor.execute(query)
+        except Exception as e:
+            if not reconnect and not conn.is_connected():
+                self.stream_conn = None
+                return self.stream(query, batch_size, True, timing)
+            raise e
+
+        def on_close():
+            if conn.unread_result:
+                # reading the rows left could take as long as the query: stop it and drop the session
+                self.kill_query(conn)
+                conn.close()
+                if self.stream_conn is conn:
+                    self.stream_conn = None
+            else:
+                conn.commit()
+
+        self.result_set = ResultSet(cursor, batch_size, on_close, self, query, timing)
+        if not self.result_set.has_more and self.result_set.pending is None:
+            self.result_set.close()
+        return self.result_set
+
+    def split(self, script):
+        return split_statements(script, mysql=True)
+
+    def stream_session(self):
+        """ The streaming session, without an open result set. """
+        if self.result_set:
+            self.result_set.close()
+            self.result_set = None
+        if self.stream_conn is None or not self.stream_conn.is_connected():
+            self.stream_conn = self.open()
+        return self.stream_conn
+
+    def run_script(self, statements, row_limit=SCRIPT_ROW_LIMIT):
+        """
+        Run `statements` in one transaction of the streaming session, rolled
+        back at the first error. They are sent in a single multi-statement
+        call and each result is read as it arrives, unless one is a CALL:
+        its results can't be told apart from the next statements', so they
+        are then sent one by one.
+        """
+        conn = self.stream_session()
+        cursor = conn.cursor(buffered=True)
+        if any(is_call(statement) for statement in statements):
+            try:
+                results = self.run_each(cursor, statements, row_limit)
+            finally:
+                cursor.close()
+            return self.end_script(conn, results)
+
+        results = []
+        last = time()
+        try:
+            for statement, result in zip(statements, cursor.execute(';\n'.join(statements), multi=True)):
+                now = time()
+                results.append(read_statement(result, statement, now - last, row_limit))
+                last = time()
+        except TypeError as e:
+            if results:
+                results.append(StatementResult(statements[len(results)], elapsed=time() - last, error=e))
+            else:  # connector 9.2+ has no multi: one call per statement
+                results = run_timed(cursor, statements, row_limit)
+        except Exception as e:
+            results.append(StatementResult(statements[len(results)], elapsed=time() - last, error=e))
+        finally:
+            cursor.close()
+        return self.end_script(conn, results)
+
+    def end_script(self, conn, results):
+        if results and results[-1].error is not None:
+            conn.rollback()
+        else:
+            conn.commit()
+        return results
+
+    def run_each(self, cursor, statements, row_limit):
+        """ Run `statements` one by one, each keeps its first result with rows (else its first result). """
+        results = []
+        for statement in statements:
+            start = time()
+            try:
+                result = None
+                for each in self.statement_results(cursor, statement):
+                    if result is None or (not result.columns and each.description):
+                        result = read_statement(each, statement, 0.0, row_limit)
+                result = result or StatementResult(statement)
+                result.elapsed = time() - start
+            except Exception as e:
+                result = StatementResult(statement, elapsed=time() - start, error=e)
+            results.append(result)
+            if result.error is not None:
+                break
+        return results
+
+    def statement_results(self, cursor, statement):
+        """ `cursor` on each result of `statement` in turn. """
+        try:
+            results = cursor.execute(statement, multi=True)
+        except TypeError:  # connector 9.2+ has no multi: the next results are read with nextset
+            results = None
+        if results is not None:
+            yield from results
+            return
+        cursor.execute(statement)
+        yield cursor
+        while cursor.nextset():
+            yield cursor
+
+    def explain(self, query, analyze=False):
+        """
+        Plan of `query`: ('mysql_json', EXPLAIN FORMAT=JSON) or, with
+        `analyze`, ('mysql_tree', EXPLAIN ANALYZE), which runs the query in a
+        transaction rolled back afterwards, on a session of its own.
+        """
+        query = query.strip().rstrip(';')
+        session = self.clone()
+        try:
+            cursor = session.conn.cursor(buffered=True)
+            if analyze:
+                cursor.execute('EXPLAIN ANALYZE ' + query)
+                plan = 'mysql_tree', '\n'.join(row[0] for row in cursor.fetchall())
+            else:
+                cursor.execute('EXPLAIN FORMAT=JSON ' + query)
+                plan = 'mysql_json', cursor.fetchone()[0]
+            cursor.close()
+            session.conn.rollback()
+        finally:
+            session.close()
+        return plan
+
+    def insert_many(self, table, columns, rows):
+        # executemany sends INSERT ... VALUES (...), (...), ... for the whole batch
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        with self.conn.cursor() as cursor:
+            cursor.executemany(sql, rows)
+
+    def load_data(self, table, columns, path):
+        """
+        Load a CSV file (with header) with LOAD DATA LOCAL INFILE, returns the
+        row count. Empty fields are loaded as NULL, as by the other import paths.
+        """
+        variables = ['@c{}'.format(i) for i in range(len(columns))]
+        sql = "LOAD DATA LOCAL INFILE %s INTO TABLE {} FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' " \
+              "LINES TERMINATED BY '\\n' IGNORE 1 LINES ({}) SET {}".format(
+                  table, ', '.join(variables),
+                  ', '.join("{} = NULLIF({}, '')".format(column, variable) for column, variable in zip(columns, variables)))
+        with self.conn.cursor() as cursor:
+            cursor.execute(sql, (path,))
+            rowcount = cursor.rowcount
+        self.conn.commit()
+        return rowcount
+
+    def cancel(self):
+        if self.stream_conn is None:
+            return
+        self.kill_query(self.stream_conn)
+
+    def kill_query(self, conn):
+        """ Stop the query of a busy session `conn`, from another one. """
+        killer = self.open()
+        try:
+            with killer.cursor() as cursor:
+                cursor.execute('KILL QUERY %s', (conn.connection_id,))
+        finally:
+            killer.close()
+
     def close(self):
+        if self.result_set:
+            self.result_set.close()
+        if self.stream_conn:
+            self.stream_conn.close()
         self.conn.close()
 
     def escape(self, type, value):
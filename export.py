@@ -0,0 +1,184 @@
+import csv
+import io
+import json
+from os.path import splitext
+
+from dialogs import inputs_dialog, progress_dialog, remove_float, text_dialog
+from driver import PsqlConnection
+from worker import Job
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'arrow')
+EXPORT_BATCH_SIZE = 10000
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class Progress:
+
+    def __init__(self):
+        self.rows = 0
+        self.bytes = 0
+        self.cancelled = False
+        self.connection = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.connection is not None:
+            self.connection.cancel()
+
+    def check(self):
+        if self.cancelled:
+            raise ExportCancelled()
+
+
+class CopyWriter(io.RawIOBase):
+    """ File given to COPY ... TO STDOUT: counts the rows and aborts the copy when cancelled. """
+
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+        self.header = True
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.progress.check()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.file.write(data)
+        rows = data.count(b'\n')
+        if self.header and rows:
+            rows -= 1
+            self.header = False
+        self.progress.rows += rows
+        self.progress.bytes += len(data)
+        return len(data)
+
+
+def write_csv(result, file, progress):
+    text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(result.columns)
+    for batch in result:
+        progress.check()
+        writer.writerows(batch)
+        progress.rows += len(batch)
+    text.flush()
+    text.detach()
+
+
+def write_jsonl(result, file, progress):
+    columns = result.columns
+    for batch in result:
+        progress.check()
+        lines = ''.join(json.dumps(dict(zip(columns, row)), default=str) + '\n' for row in batch)
+        data = lines.encode('utf-8')
+        file.write(data)
+        progress.rows += len(batch)
+        progress.bytes += len(data)
+
+
+def write_arrow(result, file, progress):
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception('Arrow export needs pyarrow (pip install pyarrow)')
+
+    columns = result.columns
+    writer = None
+    schema = None
+    try:
+        for batch in result:
+            progress.check()
+            data = {name: [row[x] for row in batch] for x, name in enumerate(columns)}
+            record_batch = pyarrow.RecordBatch.from_pydict(data, schema=schema)
+            if writer is None:
+                schema = record_batch.schema
+                writer = pyarrow.ipc.new_stream(file, schema)
+            writer.write_batch(record_batch)
+            progress.rows += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'arrow': write_arrow,
+}
+
+
+def export_query(conn, query, path, export_format, progress):
+    """
+    Stream the result of `query` to `path`, on a connection of its own.
+    PostgreSQL CSV exports go through COPY, the rest through a streaming cursor.
+    """
+    export_conn = conn.clone()
+    progress.connection = export_conn
+    try:
+        with open(path, 'wb') as file:
+            if export_format == 'csv' and isinstance(export_conn, PsqlConnection):
+                export_conn.copy_out(query, CopyWriter(file, progress))
+            else:
+                result = export_conn.stream(query, batch_size=EXPORT_BATCH_SIZE)
+                try:
+                    WRITERS[export_format](result, file, progress)
+                finally:
+                    result.close()
+        return progress.rows
+    finally:
+        export_conn.close()
+
+
+def format_for(path, export_format):
+    export_format = (export_format or '').strip().lower()
+    if not export_format:
+        export_format = splitext(path)[1].lstrip('.').lower()
+    if export_format in ('json', 'ndjson'):
+        export_format = 'jsonl'
+    if export_format in ('ipc', 'feather'):
+        export_format = 'arrow'
+    if export_format not in EXPORT_FORMATS:
+        raise Exception('Unknown export format: ' + export_format + ' (' + ', '.join(EXPORT_FORMATS) + ')')
+    return export_format
+
+
+def export_dialog(conn, query, title='Export'):
+    def callback(result):
+        path = result['File'].strip()
+        try:
+            export_format = format_for(path, result['Format (csv, jsonl, arrow)'])
+        except Exception as e:
+            text_dialog(title, str(e))
+            return
+        start_export(conn, query, path, export_format, title)
+
+    inputs_dialog(callback, title=title, subtitle=query, inputs_data=['File', 'Format (csv, jsonl, arrow)'])
+
+
+def start_export(conn, query, path, export_format, title='Export'):
+    progress = Progress()
+
+    def get_text():
+        elapsed = max(job.elapsed(), 0.001)
+        return '{} rows ({:.0f} rows/s) to {} in {:.1f}s'.format(progress.rows, progress.rows / elapsed, path, elapsed)
+
+    def cancel():
+        progress.cancelled = True
+        job.cancel()
+
+    def done(rows):
+        remove_float(float_dialog)
+        text_dialog(title, '{} rows exported to {} in {:.1f}s'.format(rows, path, job.elapsed()))
+
+    def error(e):
+        remove_float(float_dialog)
+        text_dialog(title, 'Export cancelled' if progress.cancelled else str(e))
+
+    job = Job(lambda: export_query(conn, query, path, export_format, progress), done, error, cancel=progress.cancel)
+    float_dialog = progress_dialog(title + ' ' + export_format, get_text, cancel)
+    return job
@@ -0,0 +1,143 @@
+import asyncio
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import merge
+
+from prompt_toolkit.application import get_app
+
+# cells compared before giving the event loop back to the UI
+FIND_CHUNK_CELLS = 20000
+
+
+class ResultFinder:
+    """
+    Incremental search of a text in the cells of a DynamicTable view.
+
+    Columns are scanned one after the other in chunks, yielding to the
+    event loop between chunks. Matches are kept sorted as `y * columns + x`
+    so that next/prev is a bisect. When the new text contains the previous
+    one, only the previous matches are checked again.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.needle = ''
+        self.matches = array('Q')
+        self.complete = True
+        self.generation = 0
+        self.current = None
+
+    def clear(self):
+        self.generation += 1
+        self.needle = ''
+        self.matches = array('Q')
+        self.complete = True
+        self.current = None
+
+    def key(self, y, x):
+        return y * self.table.max['x'] + x
+
+    def position(self, key):
+        return divmod(key, self.table.max['x'])
+
+    def is_match(self, y, x):
+        key = self.key(y, x)
+        i = bisect_left(self.matches, key)
+        return i < len(self.matches) and self.matches[i] == key
+
+    def text(self, y, x):
+        table = self.table
+        return table.data.text(table.view.index(y), x).lower()
+
+    def search(self, needle):
+        previous = self.needle
+        self.generation += 1
+        self.needle = needle
+        self.current = None
+        if not needle:
+            self.matches = array('Q')
+            self.complete = True
+            return
+
+        if previous and previous.lower() in needle.lower() and self.complete:
+            steps = self.narrow(needle.lower())
+        else:
+            steps = self.scan(needle.lower())
+        self.complete = False
+        self.run(steps, self.generation)
+
+    def run(self, steps, generation):
+        app = get_app()
+        if getattr(app, 'loop', None) is None or not app.is_running:
+            for _ in steps:
+                pass
+            return
+
+        async def runner():
+            for _ in steps:
+                if generation != self.generation:
+                    return
+                self.table.invalidateEvent.fire()
+                await asyncio.sleep(0)
+
+        app.create_background_task(runner())
+
+    def scan(self, needle):
+        self.matches = array('Q')
+        table = self.table
+        rows = len(table.view)
+        for x in range(table.max['x']):
+            hits = array('Q')
+            for start in range(0, rows, FIND_CHUNK_CELLS):
+                for y in range(start, min(start + FIND_CHUNK_CELLS, rows)):
+                    if needle in self.text(y, x):
+                        hits.append(self.key(y, x))
+                yield
+            self.matches = array('Q', merge(self.matches, hits))
+            self.found()
+        self.complete = True
+        yield
+
+    def narrow(self, needle):
+        previous = self.matches
+        kept = array('Q')
+        for start in range(0, len(previous), FIND_CHUNK_CELLS):
+            for key in previous[start:start + FIND_CHUNK_CELLS]:
+                y, x = self.position(key)
+                if needle in self.text(y, x):
+                    kept.append(key)
+            yield
+        self.matches = kept
+        self.complete = True
+        self.found()
+        yield
+
+    def found(self):
+        """ Jump to the first match after the cursor once there is one. """
+        if self.current is None and len(self.matches) > 0:
+            self.jump(0)
+
+    def jump(self, direction):
+        if len(self.matches) == 0:
+            return
+        table = self.table
+        key = self.key(table.offset['y'], table.offset['x'])
+        if direction > 0:
+            i = bisect_right(self.matches, key)
+        elif direction < 0:
+            i = bisect_left(self.matches, key) - 1
+        else:
+            i = bisect_left(self.matches, key)
+        i %= len(self.matches)
+        self.current = i
+        y, x = self.position(self.matches[i])
+        table.move_offset(x - table.offset['x'], y - table.offset['y'])
+
+    def status(self):
+        if not self.needle:
+            return ''
+        count = len(self.matches)
+        suffix = '' if self.complete else '+ ...'
+        if self.current is None or count == 0:
+            return '{}{} matches'.format(count, suffix)
+        return '{}/{}{} matches'.format(min(self.current, count - 1) + 1, count, suffix)
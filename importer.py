@@ -0,0 +1,150 @@
+import csv
+import io
+import json
+from itertools import islice
+from os.path import splitext
+
+from cache import RESULT_CACHE
+from dialogs import inputs_dialog, progress_dialog, remove_float, text_dialog
+from driver import MySqlConnection, PsqlConnection
+from export import Progress
+from worker import Job
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+IMPORT_BATCH_SIZE = 10000
+IMPORT_COMMIT_INTERVAL = 100000
+
+
+def read_csv(file):
+    reader = csv.reader(file)
+    columns = next(reader)
+    # as with COPY in csv format, empty fields are nulls
+    return columns, ([value if value != '' else None for value in row] for row in reader)
+
+
+def read_jsonl(file):
+    lines = (line for line in file if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return [], iter([])
+    first = json.loads(first)
+    columns = list(first)
+
+    def cell(value):
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return value
+
+    def rows():
+        yield [cell(first.get(column)) for column in columns]
+        for line in lines:
+            obj = json.loads(line)
+            yield [cell(obj.get(column)) for column in columns]
+
+    return columns, rows()
+
+
+def batches(rows, size):
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_file(conn, table, path, import_format, progress,
+                batch_size=IMPORT_BATCH_SIZE, commit_interval=IMPORT_COMMIT_INTERVAL):
+    """
+    Load a CSV (with header) or JSON Lines file into `table`, on a connection
+    of its own. PostgreSQL gets one COPY FROM STDIN per batch, MySQL batched
+    multi-row inserts, or LOAD DATA LOCAL INFILE when `local_infile` is set.
+    """
+    import_conn = conn.clone()
+    try:
+        with open(path, newline='' if import_format == 'csv' else None, encoding='utf-8') as file:
+            columns, rows = read_csv(file) if import_format == 'csv' else read_jsonl(file)
+            columns = [import_conn.escape('id', column) for column in columns]
+
+            if import_format == 'csv' and isinstance(import_conn, MySqlConnection) \
+                    and import_conn.options.get('local_infile'):
+                progress.rows = import_conn.load_data(table, columns, path)
+                return progress.rows
+
+            pending = 0
+            for batch in batches(rows, batch_size):
+                progress.check()
+                if isinstance(import_conn, PsqlConnection):
+                    buffer = io.StringIO()
+                    csv.writer(buffer).writerows(batch)
+                    buffer.seek(0)
+                    import_conn.copy_in(table, columns, buffer)
+                else:
+                    import_conn.insert_many(table, columns, batch)
+                progress.rows += len(batch)
+                pending += len(batch)
+                if pending >= commit_interval:
+                    import_conn.commit()
+                    pending = 0
+            import_conn.commit()
+        return progress.rows
+    except Exception:
+        import_conn.rollback()
+        raise
+    finally:
+        import_conn.close()
+        RESULT_CACHE.invalidate(conn)
+
+
+def format_for(path, import_format):
+    import_format = (import_format or '').strip().lower()
+    if not import_format:
+        import_format = splitext(path)[1].lstrip('.').lower()
+    if import_format in ('json', 'ndjson'):
+        import_format = 'jsonl'
+    if import_format not in IMPORT_FORMATS:
+        raise Exception('Unknown import format: ' + import_format + ' (' + ', '.join(IMPORT_FORMATS) + ')')
+    return import_format
+
+
+def import_dialog(conn, table, title='Import'):
+    def callback(result):
+        path = result['File'].strip()
+        try:
+            import_format = format_for(path, result['Format (csv, jsonl)'])
+            batch_size = int(result['Batch size'] or IMPORT_BATCH_SIZE)
+            commit_interval = int(result['Commit every (rows)'] or IMPORT_COMMIT_INTERVAL)
+        except Exception as e:
+            text_dialog(title, str(e))
+            return
+        start_import(conn, table, path, import_format, batch_size, commit_interval, title)
+
+    inputs_dialog(callback, title=title,
+                  subtitle='Into {} (batch size {} and commit every {} rows by default)'.format(
+                      table, IMPORT_BATCH_SIZE, IMPORT_COMMIT_INTERVAL),
+                  inputs_data=['File', 'Format (csv, jsonl)', 'Batch size', 'Commit every (rows)'])
+
+
+def start_import(conn, table, path, import_format, batch_size, commit_interval, title='Import'):
+    progress = Progress()
+
+    def get_text():
+        elapsed = max(job.elapsed(), 0.001)
+        return '{} rows ({:.0f} rows/s) from {} in {:.1f}s'.format(progress.rows, progress.rows / elapsed, path, elapsed)
+
+    def cancel():
+        progress.cancelled = True
+        job.cancel()
+
+    def done(rows):
+        remove_float(float_dialog)
+        text_dialog(title, '{} rows imported into {} in {:.1f}s'.format(rows, table, job.elapsed()))
+
+    def error(e):
+        remove_float(float_dialog)
+        text_dialog(title, 'Import cancelled (rows of the last uncommitted batches were rolled back)'
+                    if progress.cancelled else str(e))
+
+    job = Job(lambda: import_file(conn, table, path, import_format, progress, batch_size, commit_interval),
+              done, error)
+    float_dialog = progress_dialog(title + ' ' + import_format, get_text, cancel)
+    return job
@@ -0,0 +1,147 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+
+from prompt_toolkit.application import get_app
+
+from metrics import REGISTRY
+from tree import FILE_ITEM_NODE
+from worker import call_in_ui
+
+# connections querying the catalog at the same time, unless `index_workers` is set for the server
+INDEX_WORKERS = 4
+
+
+class TreeIndexer:
+    """
+    Loads every node below a root in the background. Catalog queries run in
+    a pool of `workers` threads, one per connection owner (server or
+    database node) at a time, each on a connection of its own; the items are
+    created on the UI thread, so the tree stays usable while it is indexed.
+    Items without `fetch_children` (not database nodes) are opened directly.
+    """
+
+    def __init__(self, tree, root, workers=INDEX_WORKERS, on_done=None):
+        self.tree = tree
+        self.root = root
+        self.on_done = on_done
+        self.app = get_app()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sqltui-index')
+        self.lock = Lock()
+        # items waiting for a query, by connection owner
+        self.queues = {}
+        self.found = 0
+        self.in_flight = 0
+        self.errors = 0
+        self.cancelled = False
+        self.finished = False
+        self.started = perf_counter()
+
+    def start(self):
+        self.visit(self.root)
+        self.check_finished()
+
+    def visit(self, item):
+        """ Load the children of `item` (now, or queued when they need a query), then theirs. """
+        if item.children:
+            self.found += len(item.children)
+            for child in item.children:
+                self.visit(child)
+        elif item.node_type == FILE_ITEM_NODE and item.visit_callback:
+            if hasattr(item, 'fetch_children'):
+                rows = item.cached_children()
+                if rows is None:
+                    self.enqueue(item)
+                    return
+                item.set_children(item.create_children(rows))
+            else:
+                item.open(indexing=True)
+            if item.children:
+                self.visit(item)
+
+    def enqueue(self, item):
+        owner = item.index_owner()
+        with self.lock:
+            queue = self.queues.get(owner)
+            if queue is None:
+                queue = self.queues[owner] = deque()
+                start = True
+            else:
+                start = False
+            queue.append(item)
+        if start:
+            self.executor.submit(self.drain, owner, queue)
+
+    def drain(self, owner, queue):
+        """ Worker: query the children of the queued items of one owner, on one connection. """
+        conn = None
+        offline = False
+        try:
+            while not self.cancelled:
+                with self.lock:
+                    if not queue:
+                        del self.queues[owner]
+                        break
+                    item = queue.popleft()
+                    self.in_flight += 1
+                rows = None
+                if conn is None and not offline:
+                    try:
+                        conn = owner.new_connection()
+                    except Exception:
+                        offline = True
+                if conn is not None:
+                    try:
+                        rows = item.fetch_children(conn)
+                    except Exception:
+                        pass
+                if rows is None:
+                    # unreachable server or failed query: the snapshot, when there is one
+                    rows = item.cached_children(stale=True)
+                call_in_ui(self.app, self.loaded, item, rows)
+        finally:
+            if conn is not None:
+                conn.close()
+        # the last item may have been loaded before its queue was removed
+        call_in_ui(self.app, self.check_finished)
+
+    def loaded(self, item, rows):
+        with self.lock:
+            self.in_flight -= 1
+        if rows is None:
+            self.errors += 1
+        elif not self.cancelled and not item.children:
+            item.set_children(item.create_children(rows))
+            if item.isOpen:
+                self.tree.dirty = True
+            self.visit(item)
+        self.check_finished()
+        self.app.invalidate()
+
+    def check_finished(self):
+        with self.lock:
+            if self.finished or (not self.cancelled and (self.queues or self.in_flight)):
+                return
+            self.finished = True
+        self.executor.shutdown(wait=False)
+        REGISTRY.observe('tree_explore_index', perf_counter() - self.started)
+        if self.on_done:
+            self.on_done(self)
+
+    def cancel(self):
+        """ Stop querying: the queries in flight finish, their results are dropped. """
+        self.cancelled = True
+        with self.lock:
+            for queue in self.queues.values():
+                queue.clear()
+        self.check_finished()
+
+    def status(self):
+        with self.lock:
+            queued = sum(len(queue) for queue in self.queues.values())
+        text = 'Indexing {}: {} nodes, {} queries in flight, {} queued (F6 to cancel)'.format(
+            self.root.plain_text(), self.found, self.in_flight, queued)
+        if self.errors:
+            text += ', {} failed'.format(self.errors)
+        return text
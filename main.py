@@ -1,26 +1,42 @@
+import asyncio
+import os
 import re
+import signal
+from collections import deque
 
-from math import floor
 from prompt_toolkit import Application, HTML
 from prompt_toolkit.application import get_app
 from prompt_toolkit.buffer import Buffer
-from prompt_toolkit.filters import has_focus, is_true
+from prompt_toolkit.filters import Condition, has_focus, is_true
 from prompt_toolkit.key_binding import merge_key_bindings
 from prompt_toolkit.keys import Keys
 from prompt_toolkit.layout import Window, HSplit, BufferControl, Layout, VSplit, FloatContainer, FormattedTextControl
 from prompt_toolkit.layout.dimension import Dimension as D
 from prompt_toolkit.lexers import PygmentsLexer
-from prompt_toolkit.widgets import HorizontalLine, Label
-from time import time
+from prompt_toolkit.widgets import HorizontalLine
 
+from cache import RESULT_CACHE, is_read_only
 from db_tree import DatabaseTree
-from dialogs import inputs_dialog
+from dialogs import buttons_dialog, inputs_dialog, text_dialog
 from frame import CustomFrame
 from keys import CustomKeyBindings
+from metrics import REGISTRY
+from plan import plan_tree
+from profiler import Profiler, memory_report
+from runner import RowsResult, ScriptResult
 from table import DynamicTable
+from store import SpillStore, parse_size
 from tabs import Tabs, Tab
+from timing import TIMINGS_PER_TAB, QueryTiming, format_history
+from worker import Job
 
 current_connection = None
+current_job = None
+
+STATS_TAB = 'Stats'
+profiler = Profiler()
+# written on exit and on SIGUSR1: JSON for a .json file, else Prometheus text format
+METRICS_FILE = os.environ.get('SQLTUI_METRICS')
 
 
 def execute_params(tab_name, conn, query, after=None):
@@ -60,7 +76,13 @@ def set_tab_text(tab, text):
     tab.body.children[2].content.buffer.text = text
 
 
+def is_query_tab(tab):
+    return hasattr(tab, 'conn')
+
+
 def get_tab_text(tab):
+    if not is_query_tab(tab):
+        return None
     return tab.body.children[2].content.buffer.text
 
 
@@ -73,59 +95,122 @@ def add_tab(tab_name, conn, content):
         ))
     ]))
     tab.conn = conn
+    tab.timings = deque(maxlen=TIMINGS_PER_TAB)
+    tab.on_close.append(close_tab_result)
     set_tab_text(tab, content)
     windows['query'].add(tab)
 
 
-last_time = -1
-last_viewport = None
+def close_tab_result(tab):
+    if windows['result_data'].owner is tab:
+        windows['result_data'].clear()
+        windows['result_data'].owner = None
+        windows['result_text'].buffer.text = ''
 
 
-def calculateResultDataViewport():
-    global last_time, last_viewport
-    now = time()
-    if last_viewport is None or (now - last_time) > 5:
-        size = get_app().output.get_size()
-        width = size.columns / 2 - 5
-        height = size.rows - 10
-        viewport = (floor(width / 15), floor(height / 3))
-        last_time = now
-        last_viewport = viewport
-        return viewport
-    else:
-        return last_viewport
+def result_status(table):
+    result = table.result
+    count = str(len(table.data)) + ('+' if result.has_more or table.fetch_error is not None else '')
+    spilled = ' (on disk)' if isinstance(table.data, SpillStore) else ''
+    shown = '' if table.view.filter is None else ' ({} shown)'.format(len(table.view))
+    title = getattr(result, 'title', '')
+    failed = '' if table.fetch_error is None else '\nFetch failed: ' + str(table.fetch_error)
+    windows['result_text'].buffer.text = (title + ' ' if title else '') + count + ' Rows' + shown + spilled \
+        + failed + '\n' + table.timing.summary()
 
 
-def execute(tab_name, conn, query, callback=None):
+def execute(tab_name, conn, query, callback=None, open_result=None, refresh=False):
+    global current_job
     if windows['query'].isEmpty() or get_tab_text(windows['query'].current()) != query:
         add_tab(tab_name, conn, query)
-    try:
-        result, columns = conn.execute(query)
-
-        if len(result) > 0:
-            if len(columns) > 0:
-                columnLabels = [Label(col) for col in columns]
-                rowsLabels = [[Label(str(cell)) for cell in row] for row in result]
-
-                # console = Console(file=StringIO())
-                # console.print(table)
-                # str_output = console.file.getvalue()
-
-                windows['result_text'].buffer.text = str(len(result)) + ' Rows'
-                windows['result_data'].reset(data=rowsLabels, header=columnLabels,
-                                             viewport=calculateResultDataViewport(),
-                                             max=(len(columns), len(result)))
+
+    if current_job is not None:
+        current_job.cancel()
+        current_job = None
+
+    tab = windows['query'].current()
+    tab.last_query = query
+    REGISTRY.inc('queries', server=conn.name())
+    job = None
+
+    def done(result):
+        if current_job is not job:
+            # superseded by another query
+            superseded()
+            return
+        if result.timing is None:
+            result.timing = QueryTiming(query)
+        timing = result.timing
+        tab.timings.append(timing)
+        if len(result.columns) > 0:
+            windows['result_data'].on_fetch = result_status
+            windows['result_data'].owner = tab
+            windows['result_data'].reset(result, memory_threshold=parse_size(conn.options.get('memory_threshold')))
+            timing.finish()
+            if len(windows['result_data'].data) == 0:
+                windows['result_text'].buffer.text = 'Executed ! (no rows)\n' + timing.summary()
             else:
-                windows['result_text'].buffer.text = 'Affected rows ' + str(len(result))
+                result_status(windows['result_data'])
         else:
-            windows['result_text'].buffer.text = 'Executed ! (no rows)'
+            timing.finish()
+            if result.rowcount >= 0:
+                windows['result_text'].buffer.text = 'Affected rows ' + str(result.rowcount) + '\n' + timing.summary()
+            else:
+                windows['result_text'].buffer.text = 'Executed ! (no rows)\n' + timing.summary()
         windows['tree'].dirty = True
-    except Exception as e:
-        windows['result_text'].buffer.text = str(e)
-
-    if callback:
-        callback()
-
+        finished()
+
+    def error(e):
+        if current_job is not job:
+            superseded()
+            return
+        windows['result_text'].buffer.text = 'Cancelled' if job.cancelled else str(e)
+        finished()
+
+    def superseded():
+        # the result panel belongs to the next query, but a write may have run
+        if not all(is_read_only(statement) for statement in statements):
+            RESULT_CACHE.invalidate(conn)
+
+    def finished():
+        global current_job
+        if current_job is job:
+            current_job = None
+        superseded()
+        if callback:
+            callback()
+
+    def running(job):
+        windows['result_text'].buffer.text = 'Running... ({:.1f}s)'.format(job.elapsed())
+
+    statements = conn.split(query) if open_result is None else []
+    cached = open_result is None and RESULT_CACHE.enabled(conn, query)
+
+    entry = RESULT_CACHE.get(conn, query) if cached and not refresh else None
+    if entry is not None:
+        REGISTRY.inc('result_cache_hits', server=conn.name())
+        title = '(cached {:.0f}s ago, Ctrl-R to refresh)'.format(entry.age())
+        result = RowsResult(entry.columns, entry.rows, conn, query, title)
+        result.cached = True
+        done(result)
+        return
+
+    if len(statements) > 1:
+        def run_script():
+            timing = QueryTiming(query)
+            with timing.measure('execute'):
+                results = conn.run_script(statements)
+            return ScriptResult(conn, statements, results, timing)
+
+        job = Job(run_script, done, error, cancel=conn.cancel, on_tick=running, serial=conn)
+    elif cached:
+        job = Job(lambda: RESULT_CACHE.recording(conn.stream(query), conn, query), done, error,
+                  cancel=conn.cancel, on_tick=running, serial=conn)
+    elif open_result is None:
+        job = Job(lambda: conn.stream(query), done, error, cancel=conn.cancel, on_tick=running, serial=conn)
+    else:
+        job = Job(open_result, done, error, on_tick=running)
+    current_job = job
     get_app().invalidate()
 
 
@@ -133,7 +218,7 @@ def frame_title(name, key):
     return HTML(name + ' <b><reverse>[' + key + ']</reverse></b>').formatted_text
 
 
-tree = DatabaseTree(execute_params, add_tab)
+tree = DatabaseTree(execute_params, add_tab, execute)
 
 queryTabs = Tabs(
     [],
@@ -228,7 +313,10 @@ def exit_(event):
     get_app().exit()
 
 
-@kb.add('Execute', 'Ctrl-E', Keys.ControlE, filter=has_focus(windows['query'].container))
+current_is_query_tab = Condition(lambda: not windows['query'].isEmpty() and is_query_tab(windows['query'].current()))
+
+
+@kb.add('Execute', 'Ctrl-E', Keys.ControlE, filter=has_focus(windows['query'].container) & current_is_query_tab)
 def _execute(event):
     if not windows['query'].isEmpty():
         tab = windows['query'].current()
@@ -236,6 +324,109 @@ def _execute(event):
         execute(tab.name, tab.conn, text)
 
 
+def current_statement(tab):
+    """ Statement of the query tab under its cursor. """
+    buffer = tab.body.children[2].content.buffer
+    statements = tab.conn.split(buffer.text)
+    if len(statements) <= 1:
+        return buffer.text
+    # a character at the cursor makes the statement it starts count when the cursor is between two
+    index = len(tab.conn.split(buffer.text[:buffer.cursor_position] + 'x')) - 1
+    return statements[max(0, min(index, len(statements) - 1))]
+
+
+def explain(tab, analyze):
+    conn = tab.conn
+    query = current_statement(tab)
+
+    def done(result):
+        kind, data = result
+
+        def show_details(text):
+            windows['result_text'].buffer.text = text
+
+        plan = plan_tree(kind, data, show_details)
+        plan_tab = Tab(('Analyze ' if analyze else 'Explain ') + tab.name, Window(content=plan))
+        windows['query'].add(plan_tab)
+        get_app().layout.focus(plan_tab.body)
+
+    def error(e):
+        windows['result_text'].buffer.text = str(e)
+
+    def running(job):
+        windows['result_text'].buffer.text = 'Explaining... ({:.1f}s)'.format(job.elapsed())
+
+    Job(lambda: conn.explain(query, analyze), done, error, on_tick=running)
+
+
+@kb.add('Explain', 'F4', Keys.F4, filter=has_focus(windows['query'].container) & current_is_query_tab)
+def _explain(event):
+    tab = windows['query'].current()
+    buttons_dialog('Explain', [
+        ['Explain', lambda: explain(tab, False)],
+        ['Explain Analyze (runs the query, rolled back)', lambda: explain(tab, True)],
+    ])
+
+
+result_is_cached = Condition(lambda: windows['result_data'].owner is not None
+                              and getattr(windows['result_data'].result, 'cached', False))
+
+
+@kb.add('Refresh', 'Ctrl-R', Keys.ControlR, filter=has_focus(windows['result_data'].container) & result_is_cached)
+def _refresh(event):
+    tab = windows['result_data'].owner
+    windows['query'].selected = tab
+    execute(tab.name, tab.conn, tab.last_query, refresh=True)
+
+
+@kb.add('Cancel Query', 'Ctrl-G', Keys.ControlG, filter=Condition(lambda: current_job is not None))
+def _cancel(event):
+    current_job.cancel()
+    windows['result_text'].buffer.text = 'Cancelling...'
+
+
+@kb.add('Timings', 'Ctrl-T', Keys.ControlT, filter=current_is_query_tab)
+def _timings(event):
+    tab = windows['query'].current()
+    text_dialog('Timings of ' + tab.name, format_history(tab.timings))
+
+
+# hidden: not listed in the toolbar
+@kb.add(None, None, Keys.F12)
+def _stats_tab(event):
+    for tab in windows['query'].tabs:
+        if tab.name == STATS_TAB:
+            break
+    else:
+        tab = Tab(STATS_TAB, Window(content=FormattedTextControl(REGISTRY.format, focusable=True)))
+        windows['query'].add(tab)
+    windows['query'].selected = tab
+    get_app().layout.focus(tab.body)
+
+
+@kb.add('Profiler', 'F7', Keys.F7)
+def _profiler(event):
+    if not profiler.running:
+        profiler.start()
+        windows['result_text'].buffer.text = 'Profiling... (F7 to stop)'
+    else:
+        paths = profiler.stop()
+        text_dialog('Profile written', '\n'.join(paths))
+
+
+@kb.add('Memory', 'F8', Keys.F8)
+def _memory(event):
+    def get_buffer(tab):
+        return tab.body.children[2].content.buffer if is_query_tab(tab) else None
+
+    text_dialog('Memory', memory_report(windows['result_data'], windows['tree'], windows['query'].tabs, get_buffer))
+
+
+def dump_metrics(*args):
+    if METRICS_FILE:
+        REGISTRY.dump(METRICS_FILE)
+
+
 def before_render(event):
     kb = get_app().key_bindings
 
@@ -256,18 +447,9 @@ def before_render(event):
 
     windows['bindings_toolbar'].text = text
 
-    newViewport = calculateResultDataViewport()
-
-    prev = windows['result_data'].viewport
-    new = {'x': newViewport[0], 'y': newViewport[1]}
-
-    if prev != new:
-        windows['result_data'].viewport = new
-        windows['result_data'].dirtyCount += 1
-
 
 allKb = merge_key_bindings(
-    [kb, tree.get_keybindings(), queryTabs.get_keybindings(), windows['result_data'].get_keybindings()])
+    [kb, tree.get_keybindings(), queryTabs.get_keybindings()])
 
 app = Application(
     layout=layout,
@@ -277,4 +459,17 @@ app = Application(
     before_render=before_render
 )
 app.windows = windows
-app.run()
+
+
+def start():
+    if hasattr(signal, 'SIGUSR1'):
+        # dumped from the event loop: a plain signal handler could interrupt the UI holding the registry lock
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, dump_metrics)
+    tree.start()
+
+
+try:
+    app.run(pre_run=start)
+finally:
+    tree.save_snapshot()
+    dump_metrics()
@@ -0,0 +1,185 @@
+import json
+import math
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+# sub-buckets per power of two: values are kept with about 3% of error
+HISTOGRAM_SUB_BUCKETS = 32
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    """
+    Latency histogram with log-linear buckets (as in HdrHistogram): each
+    power of two is split in HISTOGRAM_SUB_BUCKETS buckets, so memory grows
+    with the range of the values, not with their count.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def bucket(value):
+        if value <= 0:
+            return (-1075, 0)
+        mantissa, exponent = math.frexp(value)
+        return exponent, int((mantissa - 0.5) * 2 * HISTOGRAM_SUB_BUCKETS)
+
+    @staticmethod
+    def upper_bound(bucket):
+        exponent, sub = bucket
+        return math.ldexp(0.5 + (sub + 1) / (2 * HISTOGRAM_SUB_BUCKETS), exponent)
+
+    def record(self, value):
+        bucket = self.bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def cumulative(self):
+        """ (upper bound, count of values below it) of the non empty buckets. """
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            yield self.upper_bound(bucket), seen
+
+
+class Registry:
+    """ Counters and latency histograms of the application, by name and labels. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(seconds)
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(name + '_errors', **labels)
+            raise
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def timed(self, name, labels=None):
+        """
+        Decorator timing the calls of a function in the histogram `name`.
+        `labels` returns the labels of a call from its arguments.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(name, **(labels(*args, **kwargs) if labels else {})):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (h.count, h.sum, h.min, h.max, [h.percentile(q) for q in PERCENTILES],
+                                list(h.cumulative()))
+                          for key, h in self.histograms.items()}
+        return counters, histograms
+
+    def to_json(self):
+        counters, histograms = self.snapshot()
+        data = {'counters': [], 'histograms': []}
+        for (name, labels), value in sorted(counters.items()):
+            data['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+        for (name, labels), (count, total, low, high, percentiles, _) in sorted(histograms.items()):
+            data['histograms'].append({
+                'name': name, 'labels': dict(labels), 'count': count, 'sum': total, 'min': low, 'max': high,
+                'percentiles': {str(q): value for q, value in zip(PERCENTILES, percentiles)},
+            })
+        return json.dumps(data, indent=2)
+
+    def to_prometheus(self):
+        counters, histograms = self.snapshot()
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append('# TYPE sqltui_{}_total counter'.format(name))
+            for (other, labels), value in sorted(counters.items()):
+                if other == name:
+                    lines.append('sqltui_{}_total{} {}'.format(name, prometheus_labels(labels), value))
+        for name in sorted({name for name, _ in histograms}):
+            lines.append('# TYPE sqltui_{}_seconds histogram'.format(name))
+            for (other, labels), (count, total, _, _, _, buckets) in sorted(histograms.items()):
+                if other != name:
+                    continue
+                for bound, seen in buckets:
+                    lines.append('sqltui_{}_seconds_bucket{} {}'.format(
+                        name, prometheus_labels(labels + (('le', repr(bound)),)), seen))
+                lines.append('sqltui_{}_seconds_bucket{} {}'.format(
+                    name, prometheus_labels(labels + (('le', '+Inf'),)), count))
+                lines.append('sqltui_{}_seconds_sum{} {}'.format(name, prometheus_labels(labels), total))
+                lines.append('sqltui_{}_seconds_count{} {}'.format(name, prometheus_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """ Write the metrics to `path`, as JSON for a .json file, else in the Prometheus text format. """
+        text = self.to_json() if path.endswith('.json') else self.to_prometheus()
+        with open(path, 'w') as file:
+            file.write(text)
+
+    def format(self):
+        """ Text table of the metrics, shown in the stats tab. """
+        counters, histograms = self.snapshot()
+        lines = ['{:<40} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('Timer', 'Count', 'p50', 'p90', 'p99', 'Max')]
+        for (name, labels), (count, _, _, high, percentiles, _) in sorted(histograms.items()):
+            values = ['{:.1f}ms'.format(value * 1000) for value in percentiles + [high]]
+            lines.append('{:<40} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+                name + prometheus_labels(labels), count, *values))
+        if counters:
+            lines.append('')
+            lines.append('{:<40} {:>8}'.format('Counter', 'Value'))
+            for (name, labels), value in sorted(counters.items()):
+                lines.append('{:<40} {:>8}'.format(name + prometheus_labels(labels), value))
+        return '\n'.join(lines)
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join('{}="{}"'.format(key, value) for (key, _), value in zip(labels, escaped)) + '}'
+
+
+REGISTRY = Registry()
+timed = REGISTRY.timed
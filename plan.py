@@ -0,0 +1,230 @@
+import json
+import re
+
+from tree import FILE_ITEM_LEAF, FILE_ITEM_NODE, Tree, TreeItem
+
+# actual rows this many times above or below the estimate are highlighted
+ESTIMATE_WARNING = 4
+ESTIMATE_ERROR = 32
+
+# MySQL JSON plan keys holding nested operations
+MYSQL_OPERATIONS = ('query_block', 'ordering_operation', 'grouping_operation', 'duplicates_removal',
+                    'windowing', 'materialized_from_subquery', 'union_result', 'buffer_result')
+MYSQL_TREE_LINE = re.compile(r'^(\s*)-> (.*)$')
+MYSQL_COST = re.compile(r'\(cost=([\d.e+]+)(?:\.\.([\d.e+]+))? rows=([\d.e+]+)\)')
+MYSQL_ACTUAL = re.compile(r'\(actual time=([\d.e+]+)\.\.([\d.e+]+) rows=([\d.e+]+) loops=(\d+)\)')
+
+
+class PlanNode:
+    """ One operation of a query plan. Times are in ms, over all the loops. """
+
+    def __init__(self, label, cost=None, rows=None, time=None, actual_rows=None, loops=None, details=None):
+        self.label = label
+        self.cost = cost
+        self.rows = rows
+        self.time = time
+        self.actual_rows = actual_rows
+        self.loops = loops
+        self.details = details or {}
+        self.children = []
+
+    @property
+    def self_time(self):
+        """ Time spent in this node only. """
+        if self.time is None:
+            return None
+        return max(0.0, self.time - sum(child.time or 0 for child in self.children))
+
+    @property
+    def estimate_error(self):
+        """ How many times actual rows differ from the estimate (1: exact). """
+        if self.rows is None or self.actual_rows is None:
+            return None
+        return max(self.rows, 1) / max(self.actual_rows, 1) if self.rows > self.actual_rows \
+            else max(self.actual_rows, 1) / max(self.rows, 1)
+
+    def weight(self):
+        return self.time if self.time is not None else (self.cost or 0)
+
+    def sort(self):
+        """ Hottest children first, recursively. """
+        self.children.sort(key=lambda child: child.weight(), reverse=True)
+        for child in self.children:
+            child.sort()
+
+
+def postgres_node(plan):
+    label = plan.get('Node Type', '?')
+    if 'Relation Name' in plan:
+        label += ' on ' + plan['Relation Name']
+        if plan.get('Alias') and plan['Alias'] != plan['Relation Name']:
+            label += ' ' + plan['Alias']
+    if 'Index Name' in plan:
+        label += ' using ' + plan['Index Name']
+
+    loops = plan.get('Actual Loops')
+    time = rows = None
+    if 'Actual Total Time' in plan:
+        time = plan['Actual Total Time'] * (loops or 1)
+        rows = plan['Actual Rows'] * (loops or 1)
+    nested = ('Plans', 'Node Type', 'Relation Name', 'Alias', 'Index Name', 'Total Cost', 'Plan Rows',
+              'Actual Total Time', 'Actual Rows', 'Actual Loops')
+    details = {key: value for key, value in plan.items() if key not in nested}
+    estimate = plan.get('Plan Rows')
+    node = PlanNode(label, plan.get('Total Cost'), estimate * (loops or 1) if estimate is not None else None,
+                    time, rows, loops, details)
+    node.children = [postgres_node(child) for child in plan.get('Plans', [])]
+    return node
+
+
+def parse_postgres(data):
+    """ Plan of `EXPLAIN (FORMAT JSON)`, as returned by the driver (text or decoded). """
+    if isinstance(data, str):
+        data = json.loads(data)
+    root = data[0]
+    node = postgres_node(root['Plan'])
+    for key in ('Planning Time', 'Execution Time'):
+        if key in root:
+            node.details[key] = root[key]
+    return node
+
+
+def mysql_json_node(label, data):
+    cost_info = data.get('cost_info', {})
+    cost = cost_info.get('query_cost') or cost_info.get('prefix_cost') or cost_info.get('sort_cost')
+    rows = data.get('rows_produced_per_join')
+    if 'table_name' in data:
+        label = '{} on {} ({})'.format(label, data['table_name'], data.get('access_type', '?'))
+        if data.get('key'):
+            label += ' using ' + data['key']
+    details = {key: value for key, value in data.items()
+               if not isinstance(value, (dict, list)) and key != 'table_name'}
+    node = PlanNode(label, float(cost) if cost else None, rows, details=details)
+
+    for key, value in data.items():
+        if key in MYSQL_OPERATIONS or key == 'table':
+            node.children.append(mysql_json_node(key, value))
+        elif key == 'nested_loop':
+            node.children.append(PlanNode('nested_loop'))
+            node.children[-1].children = [mysql_json_node('table', item['table']) for item in value]
+        elif key in ('attached_subqueries', 'optimized_away_subqueries', 'query_specifications'):
+            for item in value:
+                node.children.append(mysql_json_node('subquery', item.get('query_block', item)))
+    return node
+
+
+def parse_mysql_json(data):
+    """ Plan of `EXPLAIN FORMAT=JSON`. """
+    if isinstance(data, str):
+        data = json.loads(data)
+    return mysql_json_node('query_block', data['query_block'])
+
+
+def parse_mysql_tree(text):
+    """ Plan of `EXPLAIN ANALYZE` (`-> operation (cost=..) (actual time=..)` lines). """
+    root = None
+    stack = []
+    for line in text.splitlines():
+        match = MYSQL_TREE_LINE.match(line)
+        if not match:
+            if stack:
+                stack[-1][1].label += ' ' + line.strip()
+            continue
+        indent, content = len(match.group(1)), match.group(2)
+        cost = MYSQL_COST.search(content)
+        actual = MYSQL_ACTUAL.search(content)
+        label = MYSQL_COST.sub('', MYSQL_ACTUAL.sub('', content)).strip()
+        node = PlanNode(label)
+        if cost:
+            node.cost = float(cost.group(2) or cost.group(1))
+            node.rows = float(cost.group(3))
+        if actual:
+            node.loops = int(actual.group(4))
+            node.time = float(actual.group(2)) * node.loops
+            node.actual_rows = float(actual.group(3)) * node.loops
+            if node.rows is not None:
+                node.rows *= node.loops
+
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        if stack:
+            stack[-1][1].children.append(node)
+        else:
+            root = node
+        stack.append((indent, node))
+    return root or PlanNode('(empty plan)')
+
+
+PARSERS = {
+    'postgres': parse_postgres,
+    'mysql_json': parse_mysql_json,
+    'mysql_tree': parse_mysql_tree,
+}
+
+
+def format_number(value):
+    if value is None:
+        return '?'
+    if isinstance(value, float) and not value.is_integer():
+        return '{:.2f}'.format(value)
+    return str(int(value))
+
+
+def node_text(node, total_time):
+    text = [('#ffffff', node.label)]
+    if node.cost is not None:
+        text.append(('#777777', '  cost ' + format_number(node.cost)))
+    if node.time is not None:
+        share = node.self_time / total_time if total_time else 0
+        style = '#ff0000' if share > 0.5 else '#ffff00' if share > 0.1 else '#00ff00'
+        text.append((style, '  {} ms ({:.0%} self)'.format(format_number(node.time), share)))
+    if node.actual_rows is not None:
+        error = node.estimate_error
+        style = '#ff0000' if error >= ESTIMATE_ERROR else '#ffff00' if error >= ESTIMATE_WARNING else '#00ffff'
+        text.append((style, '  rows {} (est. {}, x{:.1f})'.format(
+            format_number(node.actual_rows), format_number(node.rows), error)))
+    elif node.rows is not None:
+        text.append(('#00ffff', '  rows ' + format_number(node.rows)))
+    return text
+
+
+def format_details(node):
+    lines = [node.label]
+    for name, value in (('Cost', node.cost), ('Estimated rows', node.rows), ('Time (ms)', node.time),
+                        ('Self time (ms)', node.self_time), ('Rows', node.actual_rows), ('Loops', node.loops)):
+        if value is not None:
+            lines.append('{}: {}'.format(name, format_number(value)))
+    for key, value in node.details.items():
+        lines.append('{}: {}'.format(key, value))
+    return '  '.join(lines)
+
+
+class PlanItem(TreeItem):
+
+    def __init__(self, tree, parent, node, total_time):
+        self.node = node
+        self.total_time = total_time
+
+        def visit_callback(indexing=False):
+            return [PlanItem(tree, self, child, total_time) for child in node.children]
+
+        node_type = FILE_ITEM_NODE if node.children else FILE_ITEM_LEAF
+        super().__init__(tree, parent, node_type, node_text(node, total_time), True,
+                         visit_callback if node.children else None, None)
+
+
+def plan_tree(kind, data, on_select=None):
+    """ Tree showing the plan returned by a driver `explain`, hottest nodes first. """
+    root = PARSERS[kind](data)
+    root.sort()
+
+    def selected(item):
+        if on_select and isinstance(item, PlanItem):
+            on_select(format_details(item.node))
+
+    tree = Tree(selected)
+    item = PlanItem(tree, None, root, root.time)
+    tree.roots = [item]
+    tree.cursorItem = item
+    tree.dirty = True
+    return tree
@@ -0,0 +1,159 @@
+import cProfile
+import os
+import sys
+import tracemalloc
+from collections import Counter
+from tempfile import gettempdir
+from threading import Event, Thread, get_ident
+from time import strftime
+
+from store import ColumnarStore
+
+# seconds between two samples of the stacks of all the threads
+SAMPLE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 25
+# files written in this directory, default: the temporary directory
+PROFILE_DIR = os.environ.get('SQLTUI_PROFILE_DIR') or gettempdir()
+
+
+class Profiler:
+    """
+    Profiles the application while it runs. The event loop thread is traced
+    with cProfile (written as a .pstats file), and the stacks of every
+    thread, workers included, are sampled into a collapsed-stack file
+    (`frame;frame;frame count` lines, the input of flamegraph tools).
+    """
+
+    def __init__(self):
+        self.profile = None
+        self.samples = None
+        self.stop_event = None
+        self.sampler = None
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        self.samples = Counter()
+        self.stop_event = Event()
+        self.sampler = Thread(target=self.sample, name='sqltui-profiler', daemon=True)
+        self.sampler.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        """ Stop profiling, returns the paths of the files written. """
+        self.profile.disable()
+        self.stop_event.set()
+        self.sampler.join()
+
+        base = os.path.join(PROFILE_DIR, strftime('sqltui-%Y%m%d-%H%M%S'))
+        self.profile.dump_stats(base + '.pstats')
+        with open(base + '.collapsed', 'w') as file:
+            for stack, count in self.samples.most_common():
+                file.write('{} {}\n'.format(stack, count))
+
+        self.profile = None
+        self.samples = None
+        return [base + '.pstats', base + '.collapsed']
+
+    def sample(self):
+        own = get_ident()
+        while not self.stop_event.wait(SAMPLE_INTERVAL):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+
+# allocation sites: source files (or packages) of each memory category
+MEMORY_CATEGORIES = (
+    ('Tree', ('tree.py', 'db_tree.py')),
+    ('Lexer', ('pygments', 'lexers')),
+    ('Result sets', ('store.py', 'view.py', 'find.py', 'driver.py', 'browse.py', 'runner.py', 'table.py')),
+)
+
+
+def allocation_category(traceback):
+    """ Category of an allocation from the files of its traceback. """
+    parts = [frame.filename.split(os.sep) for frame in traceback]
+    for category, names in MEMORY_CATEGORIES:
+        if any(name in path for path in parts for name in names):
+            return category
+    return 'Other'
+
+
+def traced_memory():
+    """ Memory allocated since tracing started and still alive, by category. """
+    sizes = Counter()
+    for trace in tracemalloc.take_snapshot().traces:
+        sizes[allocation_category(trace.traceback)] += trace.size
+    return sizes
+
+
+def tree_size(root):
+    """ Approximate size of the objects of a tree item and its descendants. """
+    size = 0
+    items = [root]
+    while items:
+        item = items.pop()
+        size += sys.getsizeof(item) + sys.getsizeof(item.__dict__)
+        size += sys.getsizeof(item.formattedText) + sum(sys.getsizeof(text) for _, text in item.formattedText)
+        data = getattr(item, 'data', None)
+        if isinstance(data, tuple):
+            size += sys.getsizeof(data) + sum(sys.getsizeof(value) for value in data)
+        items.extend(item.children)
+    return size
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+
+
+def memory_report(result_table, tree, tabs, get_buffer):
+    """
+    Retained memory by owner: the result panel, each server subtree and
+    each query tab buffer, then by allocation site when tracemalloc traces.
+    """
+    lines = ['Owners']
+    if result_table.data is not None:
+        data = result_table.data
+        owner = result_table.owner.name if result_table.owner is not None else '-'
+        text = '  Result of {:<20} {:>10} in memory'.format(owner, format_size(data.nbytes()))
+        if not isinstance(data, ColumnarStore):
+            text += ', {} on disk'.format(format_size(data.disk_bytes()))
+        lines.append(text + ', {} rows'.format(len(data)))
+        for parent, _ in result_table.parents:
+            rows = getattr(parent, 'rows', [])
+            size = sys.getsizeof(rows) + sum(sys.getsizeof(row) for row in rows)
+            lines.append('  {:<30} {:>10}'.format('Parent result', format_size(size)))
+
+    for root in tree.roots:
+        lines.append('  Tree {:<26} {:>10}'.format(root.plain_text()[:26], format_size(tree_size(root))))
+
+    for tab in tabs:
+        buffer = get_buffer(tab)
+        if buffer is not None:
+            lines.append('  Buffer of {:<21} {:>10}'.format(tab.name[:21], format_size(sys.getsizeof(buffer.text))))
+
+    lines.append('')
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append('Allocations since tracing started (current {}, peak {})'.format(
+            format_size(current), format_size(peak)))
+        for category, size in traced_memory().most_common():
+            lines.append('  {:<31} {:>10}'.format(category, format_size(size)))
+    else:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        lines.append('Allocation tracing started: open this panel again to see them by category')
+    return '\n'.join(lines)
@@ -0,0 +1,192 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+from time import time
+
+# rows kept for each statement of a script
+SCRIPT_ROW_LIMIT = 10000
+
+DOLLAR_QUOTE = re.compile(r'\$[A-Za-z_]*\$')
+
+
+def split_statements(text, mysql=False):
+    """
+    Statements of a script, split on the semicolons outside of strings,
+    quoted identifiers, comments and $tag$ quoted bodies. Statements made
+    only of comments are dropped. `mysql` enables backslash escapes in
+    strings and `#` comments.
+    """
+    statements = []
+    start = 0
+    i = 0
+    n = len(text)
+    has_code = False
+    while i < n:
+        c = text[i]
+        if c in '\'"`':
+            i += 1
+            while i < n and text[i] != c:
+                i += 2 if mysql and text[i] == '\\' else 1
+            has_code = True
+        elif text.startswith('--', i) or c == '#' and mysql:
+            end = text.find('\n', i)
+            i = n if end < 0 else end
+        elif text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = n if end < 0 else end + 1
+        elif c == '$' and DOLLAR_QUOTE.match(text, i):
+            tag = DOLLAR_QUOTE.match(text, i).group(0)
+            end = text.find(tag, i + len(tag))
+            i = n if end < 0 else end + len(tag) - 1
+            has_code = True
+        elif c == ';':
+            if has_code:
+                statements.append(text[start:i].strip())
+            start = i + 1
+            has_code = False
+        elif not c.isspace():
+            has_code = True
+        i += 1
+    if has_code:
+        statements.append(text[start:].strip())
+    return statements
+
+
+class StatementResult:
+    """ Outcome of one statement of a script. """
+
+    def __init__(self, query, columns=(), rows=(), rowcount=-1, elapsed=0.0, error=None):
+        self.query = query
+        self.columns = list(columns)
+        self.rows = list(rows)
+        self.rowcount = rowcount
+        self.elapsed = elapsed
+        self.error = error
+
+    @property
+    def truncated(self):
+        return self.rowcount > len(self.rows)
+
+
+def read_statement(cursor, query, elapsed, row_limit=SCRIPT_ROW_LIMIT):
+    """ StatementResult of the statement `cursor` just executed. """
+    columns = [desc[0] for desc in cursor.description] if cursor.description else []
+    rows = []
+    if columns:
+        rows = cursor.fetchmany(row_limit)
+        rowcount = max(cursor.rowcount, len(rows))
+    else:
+        rowcount = cursor.rowcount
+    return StatementResult(query, columns, rows, rowcount, elapsed)
+
+
+class RowsResult:
+    """ Rows already read, shown in the result panel like a ResultSet. """
+
+    has_more = False
+    timing = None
+
+    def __init__(self, columns, rows, connection=None, query=None, title=''):
+        self.columns = list(columns)
+        self.rows = rows
+        self.rowcount = len(rows)
+        self.fetched = len(rows)
+        self.connection = connection
+        self.query = query
+        self.title = title
+
+    def fetch(self):
+        return self.rows
+
+    def fetch_all(self):
+        return self.rows
+
+    def close(self):
+        # rows stay available: the result can be shown again
+        pass
+
+
+class ScriptResult(RowsResult):
+    """
+    Summary of a script, one row per statement run. The rows returned by a
+    statement are its sub-result.
+    """
+
+    def __init__(self, connection, statements, results, timing=None):
+        self.statements = statements
+        self.timing = timing
+        self.results = results
+        rows = []
+        for i, result in enumerate(results):
+            if result.error is not None:
+                outcome = 'Error: ' + str(result.error).strip()
+            elif result.columns:
+                outcome = '{} rows'.format(result.rowcount)
+            elif result.rowcount >= 0:
+                outcome = '{} affected'.format(result.rowcount)
+            else:
+                outcome = 'OK'
+            rows.append((i + 1, ' '.join(result.query.split()), round(result.elapsed * 1000, 1), outcome))
+
+        total = sum(result.elapsed for result in results)
+        title = 'Script: {}/{} statements in {:.2f}s'.format(len(results), len(statements), total)
+        if results and results[-1].error is not None:
+            title += ', failed at #{} (rolled back)'.format(len(results))
+        super().__init__(['#', 'Statement', 'Time (ms)', 'Result'], rows, connection, None, title + ' -')
+
+    def sub_result(self, row):
+        result = self.results[row]
+        if not result.columns:
+            return None
+        title = 'Statement #{}'.format(row + 1)
+        if result.truncated:
+            title += ' (first {} of {} rows)'.format(len(result.rows), result.rowcount)
+        return RowsResult(result.columns, result.rows, self.connection, result.query, title + ' -')
+
+
+def run_timed(cursor, statements, row_limit=SCRIPT_ROW_LIMIT):
+    """ Execute `statements` one by one on `cursor`, stops at the first error. """
+    results = []
+    for statement in statements:
+        start = time()
+        try:
+            cursor.execute(statement)
+            results.append(read_statement(cursor, statement, time() - start, row_limit))
+        except Exception as e:
+            results.append(StatementResult(statement, elapsed=time() - start, error=e))
+            break
+    return results
+
+
+def count_rows(connect, scripts, workers):
+    """
+    Run the count `scripts` ((name, statements) pairs, the last statement
+    returning the count) in parallel, each worker on a connection opened by
+    `connect`. Returns (name, count, time in ms, error) rows.
+    """
+    sessions = local()
+    connections = []
+    lock = Lock()
+
+    def count(name, statements):
+        try:
+            conn = getattr(sessions, 'conn', None)
+            if conn is None:
+                conn = sessions.conn = connect()
+                with lock:
+                    connections.append(conn)
+            results = conn.run_script(statements, row_limit=1)
+        except Exception as e:
+            return name, None, None, str(e).strip()
+        elapsed = round(sum(result.elapsed for result in results) * 1000, 1)
+        last = results[-1]
+        if last.error is not None:
+            return name, None, elapsed, str(last.error).strip()
+        return name, last.rows[0][0] if last.rows else None, elapsed, ''
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sqltui-count') as executor:
+            return list(executor.map(lambda script: count(*script), scripts))
+    finally:
+        for conn in connections:
+            conn.close()
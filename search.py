@@ -0,0 +1,185 @@
+import math
+import re
+from heapq import nsmallest
+from itertools import count
+
+# results kept for a search
+SEARCH_LIMIT = 1000
+# below this many matches, names sharing most of the trigrams of the text are added
+FUZZY_MIN_RESULTS = 20
+FUZZY_MIN_SHARE = 0.6
+
+WORD = re.compile(r'[^\W_]+')
+
+# posting keys of the prefixes of a name and of its words, apart from the trigrams
+NAME_PREFIX = '\0'
+WORD_PREFIX = '\1'
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def index_keys(text):
+    """ Trigrams of `text`, prefixes of up to three letters of it and of its words. """
+    keys = trigrams(text)
+    for size in (1, 2, 3):
+        if len(text) >= size:
+            keys.add(NAME_PREFIX + text[:size])
+    for word in WORD.findall(text):
+        for size in (1, 2, 3):
+            if len(word) >= size:
+                keys.add(WORD_PREFIX + word[:size])
+    return keys
+
+
+def starts_word(name, text):
+    """ Whether `text` occurs in `name` at the start of a word (not at the start of `name`). """
+    position = name.find(text, 1)
+    while position > 0:
+        if not name[position - 1].isalnum():
+            return True
+        position = name.find(text, position + 1)
+    return False
+
+
+def rank(name, text):
+    """ 0 when `name` starts with `text`, 1 when one of its words does, 2 when it contains it, else None. """
+    if name.startswith(text):
+        return 0
+    if starts_word(name, text):
+        return 1
+    if len(text) >= 3 and text in name:
+        return 2
+    return None
+
+
+class SearchIndex:
+    """
+    Names of the items of a tree, lower-cased, for searches as you type.
+    Names are looked up by the prefixes of their words and by trigram, in
+    order of rank, and a search stops after SEARCH_LIMIT matches. Items are
+    added when they are attached to an indexed parent and removed with their
+    subtree; the posting lists keep the ids of removed items until they are
+    compacted.
+    """
+
+    def __init__(self):
+        self.ids = count()
+        # id: (item, text)
+        self.entries = {}
+        self.postings = {}
+        self.dead = 0
+        # text of the last search and ids of all its matches, narrowed while typing
+        self.last = None
+
+    def contains(self, item):
+        return getattr(item, 'search_id', None) in self.entries
+
+    def add(self, items):
+        """ Index `items` and their loaded descendants, unless they already are. """
+        pending = [item for item in items or [] if not self.contains(item)]
+        while pending:
+            item = pending.pop()
+            item.search_id = next(self.ids)
+            text = item.plain_text().lower()
+            self.entries[item.search_id] = (item, text)
+            for key in index_keys(text):
+                self.postings.setdefault(key, []).append(item.search_id)
+            self.last = None
+            # the children of an indexed item are indexed as they are set
+            pending.extend(child for child in item.children or [] if not self.contains(child))
+
+    def remove(self, items):
+        """ Forget `items` and their descendants. """
+        pending = list(items or [])
+        while pending:
+            item = pending.pop()
+            if self.entries.pop(getattr(item, 'search_id', None), None) is not None:
+                self.dead += 1
+                self.last = None
+            pending.extend(item.children or [])
+        if self.dead > max(10000, len(self.entries)):
+            self.compact()
+
+    def compact(self):
+        self.postings = {}
+        for search_id, (_, text) in self.entries.items():
+            for key in index_keys(text):
+                self.postings.setdefault(key, []).append(search_id)
+        self.dead = 0
+
+    def candidates(self, text):
+        """ Posting lists to scan, by rank: names, words and trigrams of `text`. """
+        lists = [self.postings.get(NAME_PREFIX + text[:3], []), self.postings.get(WORD_PREFIX + text[:3], [])]
+        if len(text) >= 3:
+            lists.append(min((self.postings.get(key, []) for key in trigrams(text)), key=len))
+        return lists
+
+    def search(self, text):
+        """
+        Items matching `text`, best first: names starting with it, then names
+        with a word starting with it, then names containing it (for three
+        letters or more), then (when they are few) names sharing most of its
+        trigrams. Shorter names come first within a rank.
+        """
+        text = text.lower()
+        if not text:
+            return []
+        if self.last and len(self.last[0]) >= 3 and text.startswith(self.last[0]):
+            # a letter was typed: only the names that matched can still match
+            lists = [self.last[1]]
+        else:
+            lists = self.candidates(text)
+
+        entries = self.entries
+        ranked = [[], [], []]
+        seen = set()
+        found = 0
+        for candidates in lists:
+            for search_id in candidates:
+                if search_id in seen:
+                    continue
+                seen.add(search_id)
+                entry = entries.get(search_id)
+                if entry is None:
+                    continue
+                name = entry[1]
+                name_rank = rank(name, text)
+                if name_rank is None:
+                    continue
+                ranked[name_rank].append((len(name), name, search_id))
+                found += 1
+                if found >= SEARCH_LIMIT:
+                    break
+            if found >= SEARCH_LIMIT:
+                break
+
+        ids = [result[2] for results in ranked for result in sorted(results)]
+        # all the matches are known: the next letter only has to filter them
+        self.last = (text, ids) if found < SEARCH_LIMIT else None
+        results = [entries[search_id][0] for search_id in ids]
+
+        if len(results) < FUZZY_MIN_RESULTS and len(text) >= 3:
+            results.extend(self.fuzzy(text, set(ids)))
+        return results
+
+    def fuzzy(self, text, found):
+        keys = trigrams(text)
+        minimum = max(2, math.ceil(FUZZY_MIN_SHARE * len(keys)))
+        # a name sharing `minimum` trigrams has one of the rarest len(keys) - minimum + 1
+        lists = sorted((self.postings.get(key, []) for key in keys), key=len)
+        ranked = []
+        seen = set(found)
+        for candidates in lists[:len(keys) - minimum + 1]:
+            for search_id in candidates:
+                if search_id in seen:
+                    continue
+                seen.add(search_id)
+                entry = self.entries.get(search_id)
+                if entry is None:
+                    continue
+                hits = sum(1 for key in keys if key in entry[1])
+                if hits >= minimum:
+                    ranked.append((-hits, len(entry[1]), entry[1], search_id))
+        return [self.entries[result[3]][0] for result in nsmallest(FUZZY_MIN_RESULTS, ranked)]
@@ -0,0 +1,242 @@
+from collections import Counter
+from heapq import nlargest
+from math import log
+from numbers import Number
+
+from store import DictionaryColumn, NumberColumn, ColumnarStore, cell_text, numpy
+
+# distinct values are counted exactly up to this limit, then estimated
+EXACT_DISTINCT_LIMIT = 100000
+PERCENTILES = (0.25, 0.5, 0.75, 0.95, 0.99)
+TOP_K = 10
+
+HLL_PRECISION = 14
+MASK_64 = (1 << 64) - 1
+
+
+def mix64(value):
+    """ splitmix64 finalizer, spreads Python hashes (ints hash to themselves). """
+    value = (value + 0x9E3779B97F4A7C15) & MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return value ^ (value >> 31)
+
+
+class HyperLogLog:
+    """ Approximate count of distinct values, about 1% error in 16 KB. """
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        h = mix64(hash(value) & MASK_64)
+        index = h >> (64 - self.precision)
+        rest = (h << self.precision) & MASK_64
+        rank = 1
+        while rank <= 64 - self.precision and not rest & (1 << 63):
+            rank += 1
+            rest <<= 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * log(m / zeros)
+        return int(estimate)
+
+
+def percentile(ordered, q):
+    if not len(ordered):
+        return None
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def numeric_stats(values):
+    """ Statistics of a numeric NumPy array without nulls. """
+    ordered = numpy.sort(values, kind='stable')
+    unique, counts = numpy.unique(ordered, return_counts=True)
+    top = numpy.argsort(-counts, kind='stable')[:TOP_K]
+    return {
+        'distinct': (len(unique), True),
+        'min': ordered[0].item() if len(ordered) else None,
+        'max': ordered[-1].item() if len(ordered) else None,
+        'mean': float(values.mean()) if len(values) else None,
+        'percentiles': [(q, percentile(ordered, q).item() if len(ordered) else None) for q in PERCENTILES],
+        'top': [(unique[i].item(), int(counts[i])) for i in top],
+    }
+
+
+def dictionary_stats(column, rows, length):
+    """ Statistics of the first `length` rows of a dictionary encoded column, counting its codes. """
+    # a copy: the arrays of the store may still grow while the result is fetched
+    codes = column.codes[:length]
+    if numpy is not None:
+        codes = numpy.frombuffer(codes, dtype=codes.typecode)
+        if rows is not None:
+            codes = codes[numpy.frombuffer(rows[:], dtype=numpy.uint64).astype(numpy.intp)]
+        counts = numpy.bincount(codes, minlength=len(column.dictionary))
+        nulls = int(counts[0])
+        counted = [(code, int(counts[code])) for code in range(1, len(counts)) if counts[code]]
+    else:
+        codes = Counter(codes if rows is None else (codes[i] for i in rows))
+        nulls = codes.pop(0, 0)
+        counted = list(codes.items())
+    stats = {
+        'nulls': nulls,
+        'distinct': (len(counted), True),
+        'top': [(column.dictionary[code], n) for code, n in nlargest(TOP_K, counted, key=lambda c: c[1])],
+    }
+    stats.update(ordered_stats([column.dictionary[code] for code, _ in counted], [n for _, n in counted]))
+    return stats
+
+
+def is_number(value):
+    return isinstance(value, Number) and not isinstance(value, (bool, complex))
+
+
+def ordered_stats(values, counts=None):
+    """
+    min/max of non null `values`, and mean and percentiles when they are
+    numbers. `counts` gives the number of occurrences of each value.
+    """
+    if not values:
+        return {'min': None, 'max': None}
+    if counts is None:
+        counts = [1] * len(values)
+
+    if not all(is_number(value) for value in values):
+        try:
+            return {'min': min(values), 'max': max(values)}
+        except TypeError:
+            return {'min': min(values, key=cell_text), 'max': max(values, key=cell_text)}
+
+    ordered = sorted(zip(values, counts))
+    total = sum(counts)
+    stats = {
+        'min': ordered[0][0],
+        'max': ordered[-1][0],
+        'mean': sum(value * n for value, n in ordered) / total,
+        'percentiles': [],
+    }
+    targets = [(q, int(q * (total - 1))) for q in PERCENTILES]
+    seen = 0
+    for value, n in ordered:
+        while targets and targets[0][1] < seen + n:
+            stats['percentiles'].append((targets.pop(0)[0], value))
+        seen += n
+    return stats
+
+
+def generic_stats(values):
+    """
+    Statistics of non null `values`. Occurrences are counted exactly for
+    the first EXACT_DISTINCT_LIMIT distinct values; the values seen after
+    that are only added to a HyperLogLog sketch, bounding the memory used.
+    """
+    counter = Counter()
+    sketch = None
+    for value in values:
+        try:
+            hash(value)
+        except TypeError:
+            value = cell_text(value)
+        if value in counter:
+            counter[value] += 1
+        elif sketch is None:
+            counter[value] = 1
+            if len(counter) > EXACT_DISTINCT_LIMIT:
+                sketch = HyperLogLog()
+                for known in counter:
+                    sketch.add(known)
+        else:
+            sketch.add(value)
+
+    stats = {
+        'distinct': (len(counter), True) if sketch is None else (sketch.count(), False),
+        'top': counter.most_common(TOP_K),
+    }
+    if sketch is None:
+        stats.update(ordered_stats(list(counter), list(counter.values())))
+    else:
+        stats.update(ordered_stats(values))
+    return stats
+
+
+def column_stats(store, x, rows=None):
+    """
+    Statistics of column `x` of a result store, over the store rows listed
+    in `rows` (an array of indexes) or over all of them.
+    """
+    # rows fetched from now on are left out
+    length = len(store)
+    count = len(rows) if rows is not None else length
+    column = store.columns[x] if isinstance(store, ColumnarStore) else None
+    stats = {'name': store.names[x], 'count': count}
+
+    if column is None and isinstance(store, ColumnarStore):
+        stats.update({'nulls': count, 'distinct': (0, True), 'top': []})
+        return stats
+
+    if isinstance(column, NumberColumn) and numpy is not None:
+        # copies: the arrays of the store may still grow while the result is fetched
+        values = column.as_numpy(length)
+        valid = None
+        if column.nulls is not None:
+            valid = numpy.frombuffer(column.nulls[:len(values)], dtype=numpy.uint8) == 0
+        if rows is not None:
+            index = numpy.frombuffer(rows[:], dtype=numpy.uint64).astype(numpy.intp)
+            values = values[index]
+            valid = valid[index] if valid is not None else None
+        if valid is not None:
+            values = values[valid]
+        stats['nulls'] = count - len(values)
+        stats.update(numeric_stats(values))
+        return stats
+
+    if isinstance(column, DictionaryColumn):
+        stats.update(dictionary_stats(column, rows, length))
+        return stats
+
+    values = store.column_values(x)
+    if rows is not None:
+        values = [values[i] for i in rows]
+    else:
+        values = values[:length]
+    present = [value for value in values if value is not None]
+    stats['nulls'] = count - len(present)
+    stats.update(generic_stats(present))
+    return stats
+
+
+def format_stats(stats):
+    def show(value):
+        if isinstance(value, float):
+            return '{:.6g}'.format(value)
+        return cell_text(value)
+
+    distinct, exact = stats['distinct']
+    lines = [
+        'Column     ' + stats['name'],
+        'Count      ' + str(stats['count']),
+        'Nulls      ' + str(stats['nulls']),
+        'Distinct   ' + ('' if exact else '~') + str(distinct),
+    ]
+    if 'min' in stats:
+        lines.append('Min        ' + show(stats['min']))
+        lines.append('Max        ' + show(stats['max']))
+    if 'mean' in stats:
+        lines.append('Mean       ' + show(stats['mean']))
+    for q, value in stats.get('percentiles', []):
+        lines.append('p{:<9}'.format(int(q * 100)) + show(value))
+    if stats['top']:
+        lines.append('')
+        lines.append('Top values')
+        for value, n in stats['top']:
+            lines.append('  {:>10}  {}'.format(n, show(value)))
+    return '\n'.join(lines)
@@ -0,0 +1,514 @@
+import mmap
+import pickle
+import re
+import struct
+import sys
+import tempfile
+from array import array
+from decimal import Decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# smallest array typecode able to hold a signed integer / an unsigned code
+INT_TYPECODES = [('b', 1 << 7), ('h', 1 << 15), ('i', 1 << 31), ('q', 1 << 63)]
+CODE_TYPECODES = [('B', 1 << 8), ('H', 1 << 16), ('I', 1 << 32)]
+
+# dictionary encoding is dropped when a column has more distinct values than this
+MIN_DICTIONARY_SIZE = 1024
+MAX_DICTIONARY_RATIO = 0.5
+# equal values of these types can still differ (Decimal('1.0') and Decimal('1.00'), 0.0 and -0.0)
+INEXACT_KEYS = (Decimal, float)
+
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# decoded rows of a SpillStore kept in memory (about one screen)
+SPILL_ROW_CACHE = 256
+
+
+def parse_size(value):
+    """ '512MB', '2G', '1048576' or 1048576 to a number of bytes. """
+    if value is None or isinstance(value, int):
+        return value
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)I?B?\s*', str(value).upper())
+    if not match:
+        raise ValueError('invalid size: ' + str(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def cell_text(cell):
+    if cell is None:
+        return 'NULL'
+    text = str(cell)
+    if '\n' in text or '\t' in text or '\r' in text:
+        text = text.replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ').replace('\t', ' ')
+    return text
+
+
+def typecode_for(bound, typecodes):
+    for code, limit in typecodes:
+        if bound < limit:
+            return code
+    return None
+
+
+class Column:
+    """ Base class of the columns of a ColumnarStore. """
+
+    def __init__(self):
+        self.nulls = None
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def is_null(self, i):
+        return self.nulls is not None and self.nulls[i] == 1
+
+    def set_nulls(self, start, flags):
+        if self.nulls is None:
+            if not any(flags):
+                return
+            self.nulls = bytearray(start)
+        self.nulls.extend(flags)
+
+    def get(self, i):
+        raise NotImplementedError
+
+    def text(self, i):
+        return cell_text(self.get(i))
+
+    def nbytes(self):
+        return len(self.nulls) if self.nulls is not None else 0
+
+    def values(self):
+        return [self.get(i) for i in range(self.length)]
+
+
+class ObjectColumn(Column):
+    """ Plain list of values, used when nothing more compact fits. """
+
+    def __init__(self):
+        super().__init__()
+        self.data = []
+        self.value_bytes = 0
+
+    def extend(self, values):
+        self.data.extend(values)
+        self.length = len(self.data)
+        self.value_bytes += sum(sys.getsizeof(value) for value in values if value is not None)
+        return self
+
+    def is_null(self, i):
+        return self.data[i] is None
+
+    def get(self, i):
+        return self.data[i]
+
+    def nbytes(self):
+        return 8 * self.length + self.value_bytes
+
+    def values(self):
+        return self.data
+
+
+class NumberColumn(Column):
+    """ Numbers in a typed array, nulls are stored in a separate mask. """
+
+    def __init__(self, typecode):
+        super().__init__()
+        self.data = array(typecode)
+
+    def accepts(self, value):
+        raise NotImplementedError
+
+    def extend(self, values):
+        for value in values:
+            if value is not None and not self.accepts(value):
+                return promote(self, values)
+
+        self.set_nulls(self.length, [1 if value is None else 0 for value in values])
+        self.append_values([0 if value is None else value for value in values])
+        self.length += len(values)
+        return self
+
+    def append_values(self, values):
+        self.data.extend(values)
+
+    def get(self, i):
+        if self.is_null(i):
+            return None
+        return self.data[i]
+
+    def nbytes(self):
+        return super().nbytes() + self.data.itemsize * len(self.data)
+
+    def as_numpy(self, length=None):
+        """ Copy of the first `length` values: a buffer exported from the array would make the next append fail. """
+        if numpy is None:
+            return None
+        data = self.data[:self.length if length is None else length]
+        return numpy.frombuffer(data, dtype=data.typecode) if len(data) else numpy.array([])
+
+
+class IntColumn(NumberColumn):
+
+    def __init__(self):
+        super().__init__('b')
+
+    def accepts(self, value):
+        return type(value) is int and -(1 << 63) <= value < (1 << 63)
+
+    def append_values(self, values):
+        # widen the array when the new values do not fit its item size
+        code = typecode_for(max(max(values), -min(values) - 1), INT_TYPECODES)
+        if array(code).itemsize > self.data.itemsize:
+            self.data = array(code, self.data)
+        self.data.extend(values)
+
+
+class FloatColumn(NumberColumn):
+
+    def __init__(self):
+        super().__init__('d')
+
+    def accepts(self, value):
+        return type(value) is float
+
+
+class DictionaryColumn(Column):
+    """ Repetitive values stored once, rows only keep a small integer code. """
+
+    def __init__(self):
+        super().__init__()
+        self.codes = array('B')
+        self.dictionary = []
+        self.index = {}
+        self.dictionary.append(None)
+        self.value_bytes = 0
+        self.texts = {}
+
+    def extend(self, values):
+        index = self.index
+        dictionary = self.dictionary
+        codes = []
+        try:
+            for value in values:
+                if value is None:
+                    codes.append(0)
+                    continue
+                # keyed by type too: equal values of different types (1, 1.0, True) stay apart
+                key = (type(value), value)
+                code = index.get(key)
+                if code is None:
+                    if key[0] in INEXACT_KEYS:
+                        return promote(self, values)
+                    code = len(dictionary)
+                    index[key] = code
+                    dictionary.append(value)
+                    self.value_bytes += sys.getsizeof(value)
+                codes.append(code)
+        except TypeError:  # unhashable values
+            return promote(self, values)
+
+        if len(dictionary) > MIN_DICTIONARY_SIZE and len(dictionary) > MAX_DICTIONARY_RATIO * (self.length + len(values)):
+            return promote(self, values)
+
+        code = typecode_for(len(dictionary) - 1, CODE_TYPECODES)
+        if array(code).itemsize > self.codes.itemsize:
+            self.codes = array(code, self.codes)
+        self.codes.extend(codes)
+        self.length += len(values)
+        return self
+
+    def get(self, i):
+        return self.dictionary[self.codes[i]]
+
+    def is_null(self, i):
+        return self.codes[i] == 0
+
+    def text(self, i):
+        code = self.codes[i]
+        text = self.texts.get(code)
+        if text is None:
+            text = self.texts[code] = cell_text(self.dictionary[code])
+        return text
+
+    def nbytes(self):
+        # the values, a list slot and an index entry (key tuple and hash slot) for each
+        return self.codes.itemsize * len(self.codes) + self.value_bytes + 100 * len(self.dictionary)
+
+
+class StringColumn(Column):
+    """ Mostly distinct strings, stored UTF-8 encoded in one buffer. """
+
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+        self.offsets = array('Q', [0])
+
+    def extend(self, values):
+        for value in values:
+            if value is not None and type(value) is not str:
+                return promote(self, values)
+
+        self.set_nulls(self.length, [1 if value is None else 0 for value in values])
+        data = self.data
+        offsets = self.offsets
+        for value in values:
+            if value is not None:
+                data += value.encode('utf-8', 'surrogatepass')
+            offsets.append(len(data))
+        self.length += len(values)
+        return self
+
+    def get(self, i):
+        if self.is_null(i):
+            return None
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8', 'surrogatepass')
+
+    def nbytes(self):
+        return super().nbytes() + len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+
+def promote(column, values):
+    """ Move the content of `column` to a more general column and append `values` to it. """
+    old = column.values() if len(column) else []
+    if all(value is None or type(value) is str for value in old) \
+            and all(value is None or type(value) is str for value in values):
+        new = StringColumn()
+    else:
+        new = ObjectColumn()
+    return new.extend(old).extend(values)
+
+
+def column_for(values):
+    for value in values:
+        if value is None:
+            continue
+        if type(value) is int:
+            return IntColumn()
+        if type(value) is float:
+            return FloatColumn()
+        if type(value) in INEXACT_KEYS:
+            return ObjectColumn()
+        return DictionaryColumn()
+    return None
+
+
+class ColumnarStore:
+    """
+    Result rows stored column by column.
+
+    Numbers go to typed arrays and other values are dictionary encoded until
+    they turn out to be mostly distinct. Cell text is only built on demand.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.columns = [None] * len(self.names)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, rows):
+        if not rows:
+            return
+        for x, values in enumerate(zip(*rows)):
+            column = self.columns[x]
+            if column is None:
+                column = column_for(values)
+                if column is None:
+                    continue  # only nulls so far
+                if self.length:
+                    column.extend([None] * self.length)
+            self.columns[x] = column.extend(values)
+        self.length += len(rows)
+        for x, column in enumerate(self.columns):
+            if column is None:
+                continue
+            if len(column) < self.length:
+                self.columns[x] = column.extend([None] * (self.length - len(column)))
+
+    def cell(self, y, x):
+        column = self.columns[x]
+        return None if column is None else column.get(y)
+
+    def text(self, y, x):
+        column = self.columns[x]
+        return 'NULL' if column is None else column.text(y)
+
+    def row(self, y):
+        return tuple(self.cell(y, x) for x in range(len(self.names)))
+
+    def column_values(self, x):
+        """ Indexable values of column `x`, without copies for typed columns. """
+        column = self.columns[x]
+        if column is None:
+            return [None] * self.length
+        if isinstance(column, NumberColumn) and column.nulls is None:
+            return column.data
+        return column.values()
+
+    def nbytes(self):
+        return sum(column.nbytes() for column in self.columns if column is not None)
+
+    def close(self):
+        self.columns = [None] * len(self.names)
+        self.length = 0
+
+
+def encode_cell(value):
+    if value is None:
+        return b'n'
+    kind = type(value)
+    if kind is int and -(1 << 63) <= value < (1 << 63):
+        return b'i' + struct.pack('<q', value)
+    if kind is float:
+        return b'f' + struct.pack('<d', value)
+    if kind is str:
+        data = value.encode('utf-8', 'surrogatepass')
+        return b's' + struct.pack('<I', len(data)) + data
+    if kind is bytes or kind is bytearray or kind is memoryview:
+        # bytea columns arrive as memoryview, which can't be pickled
+        data = bytes(value)
+        return b'b' + struct.pack('<I', len(data)) + data
+    try:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:  # not picklable: keep what the grid shows
+        return encode_cell(cell_text(value))
+    return b'p' + struct.pack('<I', len(data)) + data
+
+
+def decode_row(buffer, start, count):
+    row = []
+    pos = start
+    for _ in range(count):
+        tag = buffer[pos:pos + 1]
+        pos += 1
+        if tag == b'n':
+            row.append(None)
+        elif tag == b'i':
+            row.append(struct.unpack_from('<q', buffer, pos)[0])
+            pos += 8
+        elif tag == b'f':
+            row.append(struct.unpack_from('<d', buffer, pos)[0])
+            pos += 8
+        else:
+            size = struct.unpack_from('<I', buffer, pos)[0]
+            pos += 4
+            data = buffer[pos:pos + size]
+            pos += size
+            if tag == b's':
+                row.append(data.decode('utf-8', 'surrogatepass'))
+            elif tag == b'b':
+                row.append(bytes(data))
+            else:
+                row.append(pickle.loads(data))
+    return tuple(row)
+
+
+class SpillStore:
+    """
+    Result rows written to temporary files and read back through mmap.
+
+    One file holds the encoded cells, the other one the offset of each row,
+    so only the rows on screen are ever decoded in memory. Both files are
+    deleted when the store is closed.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.length = 0
+        self.data_file = tempfile.TemporaryFile(prefix='sqltui-')
+        self.offsets_file = tempfile.TemporaryFile(prefix='sqltui-')
+        self.data_size = 0
+        self.data_map = None
+        self.offsets_map = None
+        self.rows = {}
+
+    def __len__(self):
+        return self.length
+
+    def append(self, rows):
+        if not rows:
+            return
+        offsets = array('Q')
+        chunks = []
+        size = self.data_size
+        for row in rows:
+            offsets.append(size)
+            chunk = b''.join(encode_cell(value) for value in row)
+            chunks.append(chunk)
+            size += len(chunk)
+        self.data_file.seek(0, 2)
+        self.data_file.write(b''.join(chunks))
+        self.offsets_file.seek(0, 2)
+        self.offsets_file.write(offsets.tobytes())
+        self.data_size = size
+        self.length += len(rows)
+
+    def maps(self):
+        # remap when rows were appended since the last mapping
+        if self.data_map is None or len(self.data_map) < self.data_size:
+            self.data_file.flush()
+            self.offsets_file.flush()
+            if self.data_map is not None:
+                self.data_map.close()
+                self.offsets_map.close()
+            self.data_map = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.offsets_map = mmap.mmap(self.offsets_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.data_map, self.offsets_map
+
+    def row(self, y):
+        row = self.rows.get(y)
+        if row is None:
+            data, offsets = self.maps()
+            start = struct.unpack_from('<Q', offsets, 8 * y)[0]
+            row = decode_row(data, start, len(self.names))
+            if len(self.rows) >= SPILL_ROW_CACHE:
+                self.rows.clear()
+            self.rows[y] = row
+        return row
+
+    def cell(self, y, x):
+        return self.row(y)[x]
+
+    def text(self, y, x):
+        return cell_text(self.row(y)[x])
+
+    def column_values(self, x):
+        data, offsets = self.maps()
+        count = len(self.names)
+        return [decode_row(data, struct.unpack_from('<Q', offsets, 8 * y)[0], count)[x] for y in range(self.length)]
+
+    def nbytes(self):
+        # resident memory only, the files are paged in and out by the OS
+        return sum(len(row) for row in self.rows.values()) * 8
+
+    def disk_bytes(self):
+        return self.data_size + 8 * self.length
+
+    def close(self):
+        self.rows = {}
+        if self.data_map is not None:
+            self.data_map.close()
+            self.offsets_map.close()
+            self.data_map = None
+            self.offsets_map = None
+        self.data_file.close()
+        self.offsets_file.close()
+        self.length = 0
+
+
+def spill(store, batch_size=10000, close=True):
+    """ Copy a ColumnarStore to a SpillStore and free it (unless `close` is False: it may still be read). """
+    spilled = SpillStore(store.names)
+    for start in range(0, len(store), batch_size):
+        spilled.append([store.row(y) for y in range(start, min(start + batch_size, len(store)))])
+    if close:
+        store.close()
+    return spilled
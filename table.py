@@ -1,16 +1,36 @@
 #!/usr/bin/env python3
-from math import floor
+from bisect import bisect_left, bisect_right
+from time import perf_counter
 
 from prompt_toolkit.application import get_app
-from prompt_toolkit.cache import SimpleCache
-from prompt_toolkit.key_binding.key_bindings import KeyBindings
+from prompt_toolkit.filters import Condition
 from prompt_toolkit.keys import Keys
-from prompt_toolkit.layout import DynamicContainer
-# from prompt_toolkit.widgets.base import Border
-from prompt_toolkit.layout.containers import Window, VSplit, HSplit, HorizontalAlign, VerticalAlign
-from prompt_toolkit.layout.dimension import Dimension as D, sum_layout_dimensions, max_layout_dimensions, to_dimension
-from prompt_toolkit.utils import take_using_weights
-from prompt_toolkit.widgets import Label
+from prompt_toolkit.layout import UIControl, UIContent, Window
+from prompt_toolkit.mouse_events import MouseEventType
+from prompt_toolkit.utils import Event, get_cwidth
+from wcwidth import wcswidth
+
+from keys import CustomKeyBindings
+from metrics import timed
+from dialogs import inputs_dialog, loading_dialog, remove_float, text_dialog
+from export import export_dialog
+from find import ResultFinder
+from stats import column_stats, format_stats
+from store import ColumnarStore, cell_text, spill
+from timing import QueryTiming
+from view import RowView
+from worker import Job, run_in_background
+
+MAX_COLUMN_WIDTH = 40
+
+# rows of a result used to plan the column widths, and the percentile kept
+WIDTH_SAMPLE_ROWS = 1000
+WIDTH_PERCENTILE = 0.9
+
+
+def close_result(result):
+    """ Close `result` in the background, after the jobs of its connection: the server may have rows left to send. """
+    Job(result.close, serial=getattr(result, 'connection', None))
 
 
 class SpaceBorder:
@@ -111,512 +131,519 @@ class DoubleBorder:
     INTERSECT = '\u256c'
 
 
-class Merge:
-    def __init__(self, cell, merge=1):
-        self.cell = cell
-        self.merge = merge
-
-    def __iter__(self):
-        yield self.cell
-        yield self.merge
-
-
-class Table(HSplit):
-    def __init__(self, table,
-                 borders=ThinBorder, column_width=None, column_widths=[],
-                 window_too_small=None, align=VerticalAlign.JUSTIFY,
-                 padding=0, padding_char=None, padding_style='',
-                 width=None, height=None, z_index=None,
-                 modal=False, key_bindings=None, style='', selected=(-1, -1)):
-        self.selected = selected
-        self.borders = borders
-        self.column_width = column_width
-        self.column_widths = column_widths
-
-        # ensure the table is iterable (has rows)
-        if not isinstance(table, list):
-            table = [table]
-        children = [_Row(row=row, table=self, borders=borders, ypos=index)
-                    for index, row in enumerate(table)]
-
-        super().__init__(
-            children=children,
-            window_too_small=window_too_small,
-            align=align,
-            padding=padding,
-            padding_char=padding_char,
-            padding_style=padding_style,
-            width=width,
-            height=height,
-            z_index=z_index,
-            modal=modal,
-            key_bindings=key_bindings,
-            style=style)
-
-    @property
-    def columns(self):
-        return max(row.raw_columns for row in self.children)
-
-    @property
-    def _all_children(self):
-        """
-        List of child objects, including padding & borders.
-        """
-
-        def get():
-            result = []
-
-            # Padding top.
-            if self.align in (VerticalAlign.CENTER, VerticalAlign.BOTTOM):
-                result.append(Window(width=D(preferred=0)))
-
-            # Border top is first inserted in children loop.
-
-            # The children with padding.
-            prev = None
-            for child in self.children:
-                result.append(_Border(
-                    prev=prev,
-                    next=child,
-                    table=self,
-                    borders=self.borders))
-                result.append(child)
-                prev = child
-
-            # Border bottom.
-            result.append(_Border(prev=prev, next=None, table=self, borders=self.borders))
-
-            # Padding bottom.
-            if self.align in (VerticalAlign.CENTER, VerticalAlign.TOP):
-                result.append(Window(width=D(preferred=0)))
-
-            return result
-
-        return self._children_cache.get(tuple(self.children), get)
-
-    def preferred_dimensions(self, width):
-        dimensions = [[]] * self.columns
-        for row in self.children:
-            assert isinstance(row, _Row)
-            j = 0
-            for cell in row.children:
-                assert isinstance(cell, _Cell)
-
-                if cell.merge != 1:
-                    dimensions[j].append(cell.preferred_width(width))
-
-                j += cell.merge
-
-        for i, c in enumerate(dimensions):
-            yield D.exact(1)
-
-            try:
-                w = self.column_widths[i]
-            except IndexError:
-                w = self.column_width
-            if w is None:  # fitted
-                yield max_layout_dimensions(c)
-            else:  # fixed or weighted
-                yield to_dimension(w)
-        yield D.exact(1)
-
-
-class _VerticalBorder(Window):
-    def __init__(self, borders):
-        super().__init__(width=1, char=borders.VERTICAL)
-
-
-class _HorizontalBorder(Window):
-    def __init__(self, borders):
-        super().__init__(height=1, char=borders.HORIZONTAL)
-
-
-class _UnitBorder(Window):
-    def __init__(self, char):
-        super().__init__(width=1, height=1, char=char)
-
-
-class _BaseRow(VSplit):
-    @property
-    def columns(self):
-        return self.table.columns
-
-    def _divide_widths(self, width):
-        """
-        Return the widths for all columns.
-        Or None when there is not enough space.
-        """
-        children = self._all_children
-
-        if not children:
-            return []
-
-        # Calculate widths.
-        dimensions = list(self.table.preferred_dimensions(width))
-        preferred_dimensions = [d.preferred for d in dimensions]
-
-        # Sum dimensions
-        sum_dimensions = sum_layout_dimensions(dimensions)
-
-        # If there is not enough space for both.
-        # Don't do anything.
-        if sum_dimensions.min > width:
+def fit(text, width):
+    """ Pad or truncate `text` to exactly `width` cells. """
+    size = get_cwidth(text)
+    if size <= width:
+        return text + ' ' * (width - size)
+
+    result = ''
+    size = 0
+    for char in text:
+        w = get_cwidth(char)
+        if size + w > width - 1:
+            break
+        result += char
+        size += w
+    return result + '\u2026' + ' ' * (width - 1 - size)
+
+
+def display_width(text):
+    width = wcswidth(text)
+    return len(text) if width < 0 else width
+
+
+class WidthPlanner:
+    """
+    Column widths of a result, planned once from a sample of its rows.
+
+    The widths for a given terminal width are cached, so they are only
+    computed again when the terminal is resized.
+    """
+
+    def __init__(self, header, sample_rows=WIDTH_SAMPLE_ROWS, percentile=WIDTH_PERCENTILE):
+        # room for the sort and filter markers
+        self.header = [display_width(cell_text(name)) + 3 for name in header]
+        self.samples = [[] for _ in header]
+        self.sample_rows = sample_rows
+        self.percentile = percentile
+        self.sampled = 0
+        self.stats = None
+        self.layout_width = None
+        self.widths = []
+        self.offsets = [0]
+
+    def observe(self, rows):
+        if self.sampled >= self.sample_rows:
             return
-
-        # Find optimal sizes. (Start with minimal size, increase until we cover
-        # the whole width.)
-        sizes = [d.min for d in dimensions]
-
-        child_generator = take_using_weights(
-            items=list(range(len(dimensions))),
-            weights=[d.weight for d in dimensions])
-
-        i = next(child_generator)
-
-        # Increase until we meet at least the 'preferred' size.
-        preferred_stop = min(width, sum_dimensions.preferred)
-
-        while sum(sizes) < preferred_stop:
-            if sizes[i] < preferred_dimensions[i]:
-                sizes[i] += 1
-            i = next(child_generator)
-
-        # Increase until we use all the available space.
-        max_dimensions = [d.max for d in dimensions]
-        max_stop = min(width, sum_dimensions.max)
-
-        while sum(sizes) < max_stop:
-            if sizes[i] < max_dimensions[i]:
-                sizes[i] += 1
-            i = next(child_generator)
-
-        # perform merges if necessary
-        if len(children) != len(sizes):
-            tmp = []
-            i = 0
-            for c in children:
-                if isinstance(c, _Cell):
-                    inc = (c.merge * 2) - 1
-                    tmp.append(sum(sizes[i:i + inc]))
-                else:
-                    inc = 1
-                    tmp.append(sizes[i])
-                i += inc
-            sizes = tmp
-
-        return sizes
-
-
-class _Row(_BaseRow):
-    def __init__(self, row, table, borders,
-                 window_too_small=None, align=HorizontalAlign.JUSTIFY,
-                 padding=D.exact(0), padding_char=None, padding_style='',
-                 width=None, height=None, z_index=None,
-                 modal=False, key_bindings=None, style='', ypos=-1):
-        self.ypos = ypos
-        self.table = table
-        self.borders = borders
-
-        # ensure the row is iterable (has cells)
-        if not isinstance(row, list):
-            row = [row]
-        children = []
-        xpos = 0
-        for c in row:
-            m = 1
-            if isinstance(c, Merge):
-                c, m = c
-            elif isinstance(c, dict):
-                c, m = Merge(**c)
-            children.append(_Cell(cell=c, table=table, row=self, merge=m, xpos=xpos))
-            xpos += 1
-
-        super().__init__(
-            children=children,
-            window_too_small=window_too_small,
-            align=align,
-            padding=padding,
-            padding_char=padding_char,
-            padding_style=padding_style,
-            width=width,
-            height=height,
-            z_index=z_index,
-            modal=modal,
-            key_bindings=key_bindings,
-            style=style)
-
-    @property
-    def raw_columns(self):
-        return sum(cell.merge for cell in self.children)
-
-    @property
-    def _all_children(self):
-        """
-        List of child objects, including padding & borders.
-        """
-
-        def get():
-            result = []
-
-            # Padding left.
-            if self.align in (HorizontalAlign.CENTER, HorizontalAlign.RIGHT):
-                result.append(Window(width=D(preferred=0)))
-
-            # Border left is first inserted in children loop.
-
-            # The children with padding.
-            c = 0
-            for child in self.children:
-                result.append(_VerticalBorder(borders=self.borders))
-                result.append(child)
-                c += child.merge
-            # Fill in any missing columns
-            for _ in range(self.columns - c):
-                result.append(_VerticalBorder(borders=self.borders))
-                result.append(_Cell(cell=None, table=self.table, row=self))
-
-            # Border right.
-            result.append(_VerticalBorder(borders=self.borders))
-
-            # Padding right.
-            if self.align in (HorizontalAlign.CENTER, HorizontalAlign.LEFT):
-                result.append(Window(width=D(preferred=0)))
-
-            return result
-
-        return self._children_cache.get(tuple(self.children), get)
-
-
-class _Border(_BaseRow):
-    def __init__(self, prev, next, table, borders,
-                 window_too_small=None, align=HorizontalAlign.JUSTIFY,
-                 padding=D.exact(0), padding_char=None, padding_style='',
-                 width=None, height=None, z_index=None,
-                 modal=False, key_bindings=None, style=''):
-        assert prev or next
-        self.prev = prev
-        self.next = next
-        self.table = table
+        rows = rows[:self.sample_rows - self.sampled]
+        for x, values in enumerate(zip(*rows)):
+            self.samples[x].extend(display_width(cell_text(value)) for value in values)
+        self.sampled += len(rows)
+        self.stats = None
+        self.layout_width = None
+
+    def column_stats(self):
+        """ (max, percentile) display width of each column. """
+        if self.stats is None:
+            self.stats = []
+            for x, sample in enumerate(self.samples):
+                if not sample:
+                    self.stats.append((self.header[x], self.header[x]))
+                    continue
+                sample = sorted(sample)
+                self.stats.append((sample[-1], sample[int(self.percentile * (len(sample) - 1))]))
+        return self.stats
+
+    def layout(self, width):
+        """ Widths of all the columns, and their offsets (borders included). """
+        if width != self.layout_width:
+            cap = max(1, min(MAX_COLUMN_WIDTH, width - 2))
+            self.widths = []
+            for x, (maximum, percentile) in enumerate(self.column_stats()):
+                # a few long outliers should not widen the whole column
+                preferred = maximum if maximum <= percentile * 1.5 else percentile
+                self.widths.append(max(1, min(max(preferred, self.header[x]), cap)))
+            self.offsets = [0]
+            for w in self.widths:
+                self.offsets.append(self.offsets[-1] + w + 1)
+            self.layout_width = width
+        return self.widths, self.offsets
+
+
+class DynamicTable(UIControl):
+    """
+    Result grid drawing only the cells inside the window.
+
+    The cost of a render depends on the size of the window, not on the
+    number of loaded rows.
+    """
+
+    def __init__(self, result=None, borders=ThinBorder):
         self.borders = borders
+        self.invalidateEvent = Event(self)
+        self.offset = {'x': 0, 'y': 0}
+        self.scroll = {'x': 0, 'y': 0}
+        self.viewport = {'x': 0, 'y': 0}
+        self.max = {'x': 0, 'y': 0}
+        self.result = None
+        self.header = []
+        self.data = None
+        self.view = None
+        self.planner = None
+        self.memory_threshold = None
+        self.owner = None
+        self.on_fetch = None
+        self.fetching = False
+        self.fetch_error = None
+        self.parents = []
+        self.timing = QueryTiming()
+        self.finder = ResultFinder(self)
+        self.find_mode = False
+        self.key_bindings = None
+        self.container = Window(content=self)
+        if result is not None:
+            self.reset(result)
+
+    def reset(self, result=None, memory_threshold=None):
+        # also called by prompt_toolkit (UIControl.reset) when the layout is reset
+        if result is None:
+            return
+        self.clear()
+        self.result = result
+        self.timing = getattr(result, 'timing', None) or QueryTiming(getattr(result, 'query', None) or '')
+        self.memory_threshold = memory_threshold
+        self.header = list(result.columns)
+        self.planner = WidthPlanner(self.header)
+        self.data = ColumnarStore(result.columns)
+        self.view = RowView(self.data, reverse=getattr(result, 'reverse', False))
+        self.max = {'x': len(result.columns), 'y': 0}
+        self.append(result.fetch())
+
+    def clear(self):
+        if self.result is not None:
+            close_result(self.result)
+        if self.data is not None:
+            self.data.close()
+        self.result = None
+        self.data = None
+        self.view = None
+        self.header = []
+        self.offset = {'x': 0, 'y': 0}
+        self.scroll = {'x': 0, 'y': 0}
+        self.max = {'x': 0, 'y': 0}
+        self.fetching = False
+        self.fetch_error = None
+        self.parents = []
+        self.finder.clear()
+        self.find_mode = False
+        self.invalidateEvent.fire()
+
+    def append(self, batch):
+        with self.timing.measure('convert'):
+            self.planner.observe(batch)
+            self.data.append(batch)
+            self.view.refresh()
+        self.timing.rows = len(self.data)
+        self.timing.bytes = self.data.nbytes() if isinstance(self.data, ColumnarStore) else self.data.disk_bytes()
+        self.max['y'] = len(self.view)
+        if self.view.reverse and self.view.is_identity():
+            # rows read backwards are shown above the loaded ones: keep the cursor on its row
+            self.offset['y'] = min(self.offset['y'] + len(batch), self.max['y'] - 1)
+            self.scroll['y'] += len(batch)
+            if self.finder.needle:
+                needle = self.finder.needle
+                self.finder.clear()
+                self.finder.search(needle)
+        if self.on_fetch:
+            self.on_fetch(self)
+        self.invalidateEvent.fire()
+
+    def needs_rows(self):
+        """ True when the viewport gets close to the rows not read yet. """
+        if self.view.reverse:
+            return self.offset['y'] < self.viewport['y']
+        return self.offset['y'] + self.viewport['y'] >= len(self.data)
+
+    def ensure_loaded(self):
+        if self.fetching or not self.result.has_more or not self.needs_rows():
+            return
 
-        children = [_HorizontalBorder(borders=borders)] * self.columns
-
-        super().__init__(
-            children=children,
-            window_too_small=window_too_small,
-            align=align,
-            padding=padding,
-            padding_char=padding_char,
-            padding_style=padding_style,
-            width=width,
-            height=height or 1,
-            z_index=z_index,
-            modal=modal,
-            key_bindings=key_bindings,
-            style=style)
-
-    def has_borders(self, row):
-        yield None  # first (outer) border
-
-        if not row:
-            # this row is undefined, none of the borders need to be marked
-            yield from [False] * (self.columns - 1)
+        result = self.result
+        data = self.data
+        threshold = self.memory_threshold
+        self.fetching = True
+
+        def fetch():
+            batch = result.fetch()
+            # no rows are appended while fetching: the store is copied to disk here, not on the UI thread
+            if threshold and isinstance(data, ColumnarStore) and data.nbytes() > threshold:
+                return batch, spill(data, close=False)
+            return batch, None
+
+        def done(fetched):
+            batch, spilled = fetched
+            if result is not self.result:
+                if spilled is not None:
+                    spilled.close()
+                return
+            self.fetching = False
+            if spilled is not None:
+                self.data = self.view.store = spilled
+                data.close()
+            self.append(batch)
+            self.ensure_loaded()
+            get_app().invalidate()
+
+        def error(e):
+            if result is self.result:
+                self.fetching = False
+                # closed before its end: the result stays incomplete, it is not cached
+                self.fetch_error = e
+                close_result(result)
+                if self.on_fetch:
+                    self.on_fetch(self)
+                self.invalidateEvent.fire()
+
+        # after the jobs of the connection: a new stream must not start while this batch is read
+        Job(fetch, done, error, serial=getattr(result, 'connection', None))
+
+    def sort(self, x):
+        """ Toggle the sort on column `x`: ascending, descending, none. """
+        if self.view.sort_column != x:
+            self.view.sort(x)
+        elif not self.view.descending:
+            self.view.sort(x, descending=True)
         else:
-            c = 0
-            for child in row.children:
-                yield from [False] * (child.merge - 1)
-                yield True
-                c += child.merge
-
-            yield from [True] * (self.columns - c)
-
-        yield None  # last (outer) border
+            self.view.sort(None)
+        self.view_changed()
+
+    def set_filter(self, x, text):
+        self.view.set_filter(x, text)
+        self.view_changed()
+
+    def view_changed(self):
+        self.max['y'] = len(self.view)
+        if self.finder.needle:
+            # matches are positions in the view: search again
+            needle = self.finder.needle
+            self.finder.clear()
+            self.finder.search(needle)
+        self.offset['y'] = max(0, min(self.offset['y'], self.max['y'] - 1))
+        if self.on_fetch:
+            self.on_fetch(self)
+        self.invalidateEvent.fire()
 
-    @property
-    def _all_children(self):
+    def jump_to_edge(self, end):
         """
-        List of child objects, including padding & borders.
+        Move to the first or last row. A paged result whose rows in between
+        are not read yet is opened again from that end instead.
         """
-
-        def get():
-            result = []
-
-            # Padding left.
-            if self.align in (HorizontalAlign.CENTER, HorizontalAlign.RIGHT):
-                result.append(Window(width=D(preferred=0)))
-
-            def char(i, pc=False, nc=False):
-                if i == 0:
-                    if self.prev and self.next:
-                        return self.borders.LEFT_T
-                    elif self.prev:
-                        return self.borders.BOTTOM_LEFT
-                    else:
-                        return self.borders.TOP_LEFT
-
-                if i == self.columns:
-                    if self.prev and self.next:
-                        return self.borders.RIGHT_T
-                    elif self.prev:
-                        return self.borders.BOTTOM_RIGHT
-                    else:
-                        return self.borders.TOP_RIGHT
-
-                if pc and nc:
-                    return self.borders.INTERSECT
-                elif pc:
-                    return self.borders.BOTTOM_T
-                elif nc:
-                    return self.borders.TOP_T
+        result = self.result
+        reopen = getattr(result, 'tail' if end else 'head', None)
+        if reopen is not None and result.has_more and end != result.reverse:
+            def done(new):
+                if result is self.result:
+                    self.reset(new, self.memory_threshold)
                 else:
-                    return self.borders.HORIZONTAL
-
-            # Border left is first inserted in children loop.
-
-            # The children with padding.
-            pcs = self.has_borders(self.prev)
-            ncs = self.has_borders(self.next)
-            for i, (child, pc, nc) in enumerate(zip(self.children, pcs, ncs)):
-                result.append(_UnitBorder(char=char(i, pc, nc)))
-                result.append(child)
-
-            # Border right.
-            result.append(_UnitBorder(char=char(self.columns)))
-
-            # Padding right.
-            if self.align in (HorizontalAlign.CENTER, HorizontalAlign.LEFT):
-                result.append(Window(width=D(preferred=0)))
-
-            return result
-
-        return self._children_cache.get(tuple(self.children), get)
-
-
-class _Cell(HSplit):
-    def __init__(self, cell, table, row, merge=1,
-                 padding=0, char=None,
-                 padding_left=None, padding_right=None,
-                 padding_top=None, padding_bottom=None,
-                 window_too_small=None,
-                 width=None, height=None, z_index=None,
-                 modal=False, key_bindings=None, style='', xpos=-1):
-        self.xpos = xpos
-        self.table = table
-        self.row = row
-        self.merge = merge
-
-        if padding is None:
-            padding = D(preferred=0)
-
-        def get(value):
-            if value is None:
-                value = padding
-            return to_dimension(value)
-
-        self.padding_left = get(padding_left)
-        self.padding_right = get(padding_right)
-        self.padding_top = get(padding_top)
-        self.padding_bottom = get(padding_bottom)
-
-        children = []
-        children.append(Window(width=self.padding_left, char=char))
-        if cell:
-            children.append(cell)
-        children.append(Window(width=self.padding_right, char=char))
-
-        children = [
-            Window(height=self.padding_top, char=char),
-            VSplit(children),
-            Window(height=self.padding_bottom, char=char),
-        ]
+                    close_result(new)
+                get_app().invalidate()
 
-        x = self.xpos
-        y = self.row.ypos
-        if table.selected[0] == x and table.selected[1] == y:
-            style = 'reverse ' + style
+            def error(e):
+                text_dialog('Browse', str(e))
 
-        super().__init__(
-            children=children,
-            window_too_small=window_too_small,
-            width=width,
-            height=height,
-            z_index=z_index,
-            modal=modal,
-            key_bindings=key_bindings,
-            style=style)
-
-
-class DynamicTable:
+            run_in_background(reopen, done, error)
+            return
+        self.move_offset(0, (self.max['y'] - 1 if end else 0) - self.offset['y'])
 
-    def __init__(self, data=None, viewport=(4, 7), header=[], max=(0, 0)):
-        self.header = header
-        self.offset = {'x': 0, 'y': 0}
-        self.viewport = {'x': viewport[0], 'y': viewport[1]}
-        self.max = {'x': max[0], 'y': max[1]}
-        self.data = data
-        self.cache = SimpleCache(1)
-        self.container = DynamicContainer(
-            self.get_table_cache
-        )
-        self.dirtyCount = 0
-
-    def reset(self, data, viewport=(4, 7), header=[], max=(0, 0)):
-        self.header = header
-        self.offset = {'x': 0, 'y': 0}
-        self.viewport = {'x': viewport[0], 'y': viewport[1]}
-        self.max = {'x': max[0], 'y': max[1]}
-        self.data = data
-        self.dirtyCount += 1
+    def open_sub_result(self):
+        """ Show the result of the selected row (a statement of a script). """
+        sub_result = self.result.sub_result(self.view.index(self.offset['y']))
+        if sub_result is None:
+            return
+        parents = self.parents + [(self.result, self.offset['y'])]
+        self.reset(sub_result, self.memory_threshold)
+        self.parents = parents
+
+    def close_sub_result(self):
+        parents = self.parents
+        result, y = parents.pop()
+        self.reset(result, self.memory_threshold)
+        self.parents = parents
+        self.move_offset(0, y)
+
+    def header_text(self, x):
+        text = cell_text(self.header[x])
+        if self.view.sort_column == x:
+            text += ' \u25bc' if self.view.descending else ' \u25b2'
+        if self.view.filter is not None and self.view.filter[0] == x:
+            text += '*'
+        return text
 
     def move_offset(self, x, y):
         self.offset['x'] += x
         self.offset['y'] += y
+        if self.data is not None:
+            self.ensure_loaded()
         self.offset['x'] = max(0, min(self.offset['x'], self.max['x'] - 1))
         self.offset['y'] = max(0, min(self.offset['y'], self.max['y'] - 1))
-        self.dirtyCount += 1
-        get_app().invalidate()
+        self.invalidateEvent.fire()
+
+    def get_key_bindings(self):
+        if self.key_bindings is None:
+            self.key_bindings = self.create_key_bindings()
+        return self.key_bindings
+
+    def create_key_bindings(self):
+        kb = CustomKeyBindings()
 
-    def get_keybindings(self):
-        kb = KeyBindings()
+        in_find_mode = Condition(lambda: self.find_mode)
+        has_data = Condition(lambda: self.data is not None and self.max['x'] > 0)
 
-        @kb.add(Keys.Down)
+        @kb.add(None, None, Keys.Down, filter=~in_find_mode)
         def down(event):
             self.move_offset(0, 1)
 
-        @kb.add(Keys.Up)
+        @kb.add(None, None, Keys.Up, filter=~in_find_mode)
         def up(event):
             self.move_offset(0, -1)
 
-        @kb.add(Keys.Left)
+        @kb.add(None, None, Keys.Left)
         def left(event):
             self.move_offset(-1, 0)
 
-        @kb.add(Keys.Right)
+        @kb.add(None, None, Keys.Right)
         def right(event):
             self.move_offset(1, 0)
 
-        return kb
-
-    def get_table_cache(self):
-        return self.cache.get(self.dirtyCount, self.get_table)
+        @kb.add('Sort', 's', 's', filter=has_data & ~in_find_mode)
+        def sort(event):
+            self.sort(self.offset['x'])
+
+        @kb.add('Filter', 'f', 'f', filter=has_data & ~in_find_mode)
+        def filter_rows(event):
+            x = self.offset['x']
+
+            def callback(result):
+                self.set_filter(x, result['Filter'])
+                get_app().layout.focus(self.container)
+
+            inputs_dialog(callback, title='Filter ' + cell_text(self.header[x]),
+                          subtitle='> 10, = open, != 3, is null, is not null, or text contained',
+                          inputs_data=['Filter'])
+
+        @kb.add('Column Stats', 'c', 'c', filter=has_data & ~in_find_mode)
+        def stats(event):
+            x = self.offset['x']
+            rows = self.view.rows if self.view.filter is not None else None
+            float_dialog = loading_dialog(title='Computing statistics')
+
+            def done(result):
+                remove_float(float_dialog)
+                text_dialog('Statistics of ' + cell_text(self.header[x]), format_stats(result))
+
+            def error(e):
+                remove_float(float_dialog)
+                text_dialog('Statistics of ' + cell_text(self.header[x]), str(e))
+
+            run_in_background(lambda: column_stats(self.data, x, rows), done, error)
+
+        @kb.add('Export', 'e', 'e', filter=has_data & ~in_find_mode)
+        def export(event):
+            if self.result.connection is not None and self.result.query:
+                export_dialog(self.result.connection, self.result.query)
+
+        @kb.add('Find', '/', '/', filter=has_data & ~in_find_mode)
+        def find(event):
+            self.find_mode = True
+            self.finder.clear()
+            self.invalidateEvent.fire()
+
+        @kb.add(None, None, Keys.Any, filter=in_find_mode)
+        def find_type(event):
+            if event.data.isprintable():
+                self.finder.search(self.finder.needle + event.data)
+
+        @kb.add(None, None, Keys.Backspace, filter=in_find_mode)
+        def find_erase(event):
+            self.finder.current = None
+            self.finder.search(self.finder.needle[:-1])
+
+        @kb.add('Next', 'Down', Keys.Down, filter=in_find_mode)
+        @kb.add(None, None, Keys.Enter, filter=in_find_mode)
+        def find_next(event):
+            self.finder.jump(1)
+
+        @kb.add('Prev', 'Up', Keys.Up, filter=in_find_mode)
+        def find_prev(event):
+            self.finder.jump(-1)
+
+        @kb.add('Exit Find Mode', 'Esc', Keys.Escape, filter=in_find_mode)
+        def find_exit(event):
+            self.find_mode = False
+            self.finder.clear()
+            self.invalidateEvent.fire()
+
+        @kb.add('First Row', 'Home', Keys.Home, filter=has_data & ~in_find_mode)
+        def first_row(event):
+            self.jump_to_edge(False)
+
+        @kb.add('Last Row', 'End', Keys.End, filter=has_data & ~in_find_mode)
+        def last_row(event):
+            self.jump_to_edge(True)
+
+        has_sub_results = Condition(lambda: hasattr(self.result, 'sub_result') and not self.find_mode)
+        has_parent = Condition(lambda: len(self.parents) > 0 and not self.find_mode)
+
+        @kb.add('Open Result', 'Enter', Keys.Enter, filter=has_data & has_sub_results)
+        def open_sub_result(event):
+            self.open_sub_result()
+
+        @kb.add('Back', 'Backspace', Keys.Backspace, filter=has_parent)
+        def close_sub_result(event):
+            self.close_sub_result()
+
+        @kb.add('Page Down', 'PgDn', Keys.PageDown)
+        def page_down(event):
+            self.move_offset(0, max(1, self.viewport['y']))
+
+        @kb.add('Page Up', 'PgUp', Keys.PageUp)
+        def page_up(event):
+            self.move_offset(0, -max(1, self.viewport['y']))
 
-    def get_table(self):
-        if self.data is None:
-            return Label('No data')
-
-        mid_x = floor((self.viewport['x'] - 1) / 2)
-        mid_y = floor((self.viewport['y'] - 1) / 2)
+        return kb
 
-        off_x = max(0, min(self.offset['x'] - mid_x, self.max['x'] - self.viewport['x']))
-        off_y = max(0, min(self.offset['y'] - mid_y, self.max['y'] - self.viewport['y']))
+    def get_invalidate_events(self):
+        return [self.invalidateEvent]
 
-        rows = self.data[off_y:off_y + self.viewport['y']]
-        rows.insert(0, self.header)
-        sub = [row[off_x:off_x + self.viewport['x']] for row in rows]
+    def is_focusable(self):
+        return True
 
-        return Table(
-            selected=(self.offset['x'] - off_x, self.offset['y'] - off_y + 1),
-            table=sub,
-            column_width=D(weight=1),  # D.exact(25),
-            column_widths=[],
-            borders=ThinBorder)
+    def mouse_handler(self, mouse_event):
+        if mouse_event.event_type == MouseEventType.SCROLL_DOWN:
+            self.move_offset(0, 3)
+        elif mouse_event.event_type == MouseEventType.SCROLL_UP:
+            self.move_offset(0, -3)
+        else:
+            return NotImplemented
+        return None
+
+    def visible_columns(self, width):
+        """ Columns (index, width) fitting in `width`, scrolled to show the selected one. """
+        widths, offsets = self.planner.layout(width)
+        x = self.offset['x']
+        if x < self.scroll['x']:
+            self.scroll['x'] = x
+        elif offsets[x + 1] - offsets[self.scroll['x']] + 1 > width:
+            # first column such that the selected one still fits
+            self.scroll['x'] = min(x, bisect_left(offsets, offsets[x + 1] + 1 - width))
+
+        start = self.scroll['x']
+        end = max(start + 1, bisect_right(offsets, offsets[start] + width - 1) - 1)
+        end = min(end, self.max['x'])
+        return [(i, widths[i]) for i in range(start, end)]
+
+    def scroll_rows(self, rows):
+        if self.offset['y'] < self.scroll['y']:
+            self.scroll['y'] = self.offset['y']
+        elif self.offset['y'] >= self.scroll['y'] + rows:
+            self.scroll['y'] = self.offset['y'] - rows + 1
+        self.scroll['y'] = max(0, min(self.scroll['y'], self.max['y'] - rows))
+
+    def border_line(self, columns, left, middle, right):
+        line = left
+        for i, (x, w) in enumerate(columns):
+            line += self.borders.HORIZONTAL * w
+            line += right if i == len(columns) - 1 else middle
+        return [('class:table.border', line)]
+
+    def row_line(self, columns, get_text, selected_x=None, style='', y=None):
+        vertical = ('class:table.border', self.borders.VERTICAL)
+        line = [vertical]
+        matches = y is not None and len(self.finder.matches) > 0
+        for x, w in columns:
+            cell_style = style
+            if matches and self.finder.is_match(y, x):
+                cell_style = 'class:table.match underline ' + cell_style
+            if x == selected_x:
+                cell_style = 'reverse ' + cell_style
+            line.append((cell_style, fit(get_text(x), w)))
+            line.append(vertical)
+        return line
+
+    @timed('result_render')
+    def create_content(self, width, height):
+        if self.data is None or self.max['x'] == 0:
+            return UIContent(get_line=lambda i: [('', 'No data')] if i == 0 else [], line_count=height)
+
+        start = perf_counter()
+        # top border, header, separator, rows..., bottom border (and find bar)
+        rows = max(1, height - (5 if self.find_mode else 4))
+        self.viewport = {'x': width, 'y': rows}
+        self.ensure_loaded()
+        self.scroll_rows(rows)
+
+        first_row = self.scroll['y']
+        last_row = min(first_row + rows, self.max['y'])
+        columns = self.visible_columns(width)
+        b = self.borders
+
+        lines = [
+            self.border_line(columns, b.TOP_LEFT, b.TOP_T, b.TOP_RIGHT),
+            self.row_line(columns, self.header_text, style='bold'),
+            self.border_line(columns, b.LEFT_T, b.INTERSECT, b.RIGHT_T),
+        ]
+        for y in range(first_row, last_row):
+            selected_x = self.offset['x'] if y == self.offset['y'] else None
+            row = self.view.index(y)
+            lines.append(self.row_line(columns, lambda x: self.data.text(row, x), selected_x, y=y))
+        lines.append(self.border_line(columns, b.BOTTOM_LEFT, b.BOTTOM_T, b.BOTTOM_RIGHT))
+        if self.find_mode:
+            text = ' Find: ' + self.finder.needle + '   ' + self.finder.status()
+            lines.append([('reverse', fit(text, width))])
+        self.timing.set('render', perf_counter() - start)
+
+        def get_line(i):
+            return lines[i] if i < len(lines) else []
+
+        return UIContent(get_line=get_line, line_count=len(lines))
@@ -12,6 +12,12 @@ class Tab(object):
     def __init__(self, name, body):
         self.name = name
         self.body = body
+        self.on_close = []
+
+    def close(self):
+        for callback in self.on_close:
+            callback(self)
+        self.on_close = []
 
 
 class Tabs(object):
@@ -36,6 +42,7 @@ class Tabs(object):
 
     def remove(self, tab):
         self.tabs.remove(tab)
+        tab.close()
         self.updateSel()
         get_app().layout.focus(self.selected.body)
 
@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+from time import perf_counter
+
+# measurements kept per query tab
+TIMINGS_PER_TAB = 20
+
+# connect: opening or reopening the session
+# execute: sending the query until its first rows (or its status) arrive
+# fetch: reading the following batches
+# convert: storing the rows in the result panel (cells, widths, views)
+# render: drawing the last frame of the result panel
+PHASES = ('connect', 'execute', 'fetch', 'convert', 'render')
+
+
+class QueryTiming:
+    """ Time spent in each phase of one query, with the rows and bytes it returned. """
+
+    def __init__(self, query=''):
+        self.query = query
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.rows = 0
+        self.bytes = 0
+        self.started = perf_counter()
+        self.total = None
+
+    @contextmanager
+    def measure(self, phase):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] += perf_counter() - start
+
+    def set(self, phase, seconds):
+        self.phases[phase] = seconds
+
+    def finish(self):
+        """ The result is shown: total time from the start of the query. """
+        if self.total is None:
+            self.total = perf_counter() - self.started
+
+    def summary(self):
+        text = ' '.join('{} {}'.format(phase, format_seconds(self.phases[phase])) for phase in PHASES)
+        if self.total is not None:
+            text += ' | total ' + format_seconds(self.total)
+        return text + ' | {} rows, {}'.format(self.rows, format_bytes(self.bytes))
+
+
+def format_seconds(seconds):
+    if seconds >= 1:
+        return '{:.2f}s'.format(seconds)
+    return '{:.1f}ms'.format(seconds * 1000)
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return '{:.0f} {}'.format(size, unit) if unit == 'B' else '{:.1f} {}'.format(size, unit)
+        size /= 1024
+
+
+def format_history(timings):
+    """ The measurements of a tab, most recent first. """
+    lines = []
+    for timing in reversed(timings):
+        lines.append(' '.join(timing.query.split())[:100])
+        lines.append('  ' + timing.summary())
+    return '\n'.join(lines) if lines else 'No query executed in this tab'
@@ -4,8 +4,9 @@ from prompt_toolkit.keys import Keys
 from prompt_toolkit.layout import UIControl, UIContent
 from prompt_toolkit.utils import Event
 
-from dialogs import loading_dialog, remove_float, inputs_dialog
 from keys import CustomKeyBindings
+from metrics import timed
+from search import SearchIndex
 
 FILE_ITEM_NODE = 'node'
 FILE_ITEM_LEAF = 'leaf'
@@ -48,6 +49,7 @@ class TreeItem:
         self.tree.dirty = True
         get_app().invalidate()
 
+    @timed('tree_item_refresh')
     def refresh(self):
         if self.isOpen and self.visit_callback:
             self.tree.dirty = True
@@ -59,15 +61,27 @@ class TreeItem:
 
             unchanged = []
 
+            index = self.tree.search_index
             for old in oldChildren:
                 if old.hash() in newHash:
                     old.refresh()
                 else:
                     self.children.remove(old)
+                    index.remove([old])
 
             for new in newChildren:
                 if new.hash() not in oldHash and new.hash() not in unchanged:
                     self.children.insert(newChildren.index(new), new)
+                    if index.contains(self):
+                        index.add([new])
+
+    def set_children(self, children):
+        """ Replace the children, keeping the search index of the tree up to date. """
+        index = self.tree.search_index
+        index.remove(self.children)
+        self.children = children
+        if index.contains(self):
+            index.add(children)
 
     def open(self, indexing=False):
         if self.node_type == FILE_ITEM_NODE and self.isOpen:
@@ -77,10 +91,10 @@ class TreeItem:
             self.isOpen = True
 
         if not self.children and self.visit_callback:
-            self.children = self.visit_callback(indexing=indexing)
+            self.set_children(self.visit_callback(indexing=indexing))
 
-        if not self.parent:
-            self.tree.explore_index(self, 0, {"count": 0})
+        if not self.parent and not indexing:
+            self.tree.index_all(self)
 
         get_app().invalidate()
 
@@ -105,15 +119,23 @@ class Tree(UIControl):
         self.indexes = {}
         self.depths = {}
         self.search_mode = False
+        self.search_text = ''
         self.search_results = []
+        self.search_position = 0
+        self.search_index = SearchIndex()
+        # running TreeIndexer of each root
+        self.indexers = {}
         self.refresh()
 
+    @timed('tree_refresh')
     def refresh(self):
         self.dirty = False
         self.content = []
         self.indexes = {}
         oldIndex = self.cursorIndex
         self.cursorIndex = -1
+        # new roots are indexed with their loaded subtree, then their children as they are set
+        self.search_index.add(self.roots)
         for root in self.roots:
             self.explore(root, 0)
         if self.cursorIndex == -1:
@@ -148,36 +170,41 @@ class Tree(UIControl):
             for child in parent.children:
                 self.explore(child, level + 1)
 
-    def explore_index(self, parent, level, stats):
-        if not parent.isOpen:
-            parent.open(indexing=True)
-
-        if parent.children:
-            stats['count'] += len(parent.children)
-
-            for child in parent.children:
-                self.explore_index(child, level + 1, stats)
+    def index_all(self, root):
+        """ Load every node below `root` in the background. """
+        from indexing import INDEX_WORKERS, TreeIndexer
+        if root in self.indexers:
+            return
 
-        # if level == 0:
-        #     raise Exception(stats['count'])
+        def done(indexer):
+            self.indexers.pop(root, None)
+            self.dirty = True
+            get_app().invalidate()
 
-    def search_recursive(self, search, parent, results):
-        if parent:
-            if parent.plain_text().startswith(search):
-                results.insert(0, parent)
-            elif search in parent.plain_text():
-                results.append(parent)
+        # one indexer per server, each with the workers of its server
+        workers = root.index_workers() if hasattr(root, 'index_workers') else INDEX_WORKERS
+        indexer = self.indexers[root] = TreeIndexer(self, root, workers, done)
+        indexer.start()
+
+    def root_of(self, item):
+        while item is not None and item.parent is not None:
+            item = item.parent
+        return item
+
+    @timed('tree_search')
+    def search(self, text):
+        """ Search the loaded items, the cursor goes to the best match. """
+        self.search_text = text
+        self.search_results = self.search_index.search(text)
+        self.search_position = 0
+        if self.search_results:
+            self.reveal_item(self.search_results[0])
+        get_app().invalidate()
 
-            if parent.children:
-                for child in parent.children:
-                    self.search_recursive(search, child, results)
-        return results
-
-    def get_root_selected(self):
-        curr = self.cursorItem
-        while curr.parent:
-            curr = curr.parent
-        return curr
+    def jump(self, offset):
+        if self.search_results:
+            self.search_position = (self.search_position + offset) % len(self.search_results)
+            self.reveal_item(self.search_results[self.search_position])
 
     def reveal_item(self, item):
         curr = item
@@ -208,6 +235,7 @@ class Tree(UIControl):
             self.invalidateEvent.fire()
 
         in_search_mode = Condition(lambda: self.search_mode)
+        is_indexing = Condition(lambda: self.root_of(self.cursorItem) in self.indexers)
         current_is_root = Condition(lambda: self.cursorItem in self.roots)
 
         @kb.add('Down', 'Down', Keys.Down, filter=~in_search_mode)
@@ -245,7 +273,7 @@ class Tree(UIControl):
                         found = True
                         break
 
-        @kb.add(None, None, "space")
+        @kb.add(None, None, "space", filter=~in_search_mode)
         @kb.add('Toggle', 'Enter', "enter", filter=~in_search_mode)
         def _(event):
             if self.cursorItem is not None:
@@ -254,41 +282,44 @@ class Tree(UIControl):
                 self.cursorItem = self.roots[0]
                 self.cursorItem.toggle()
 
-        @kb.add('Index All Tree', 'F6', Keys.F6, filter=~in_search_mode & current_is_root)
+        @kb.add('Index All Tree', 'F6', Keys.F6, filter=~in_search_mode & current_is_root & ~is_indexing)
+        def _(event):
+            self.index_all(self.cursorItem)
+
+        # not Ctrl-G: it cancels the running query
+        @kb.add('Cancel Indexing', 'F6', Keys.F6, filter=~in_search_mode & is_indexing)
         def _(event):
-            float_dialog = loading_dialog(title='Indexing')
-            self.explore_index(self.cursorItem, 0, {"count": 0})
-            remove_float(float_dialog)
+            self.indexers[self.root_of(self.cursorItem)].cancel()
 
         @kb.add('Search', '/', '/', filter=~in_search_mode)
         def _(event):
-            def callback(result):
-                search_results = self.search_recursive(result['Search'], self.get_root_selected(), [])
-                if len(search_results) == 0:
-                    return
+            self.search_mode = True
+            self.search_text = ''
+            self.search_results = []
+            get_app().invalidate()
 
-                self.search_mode = True
-                self.search_results = search_results
-                self.reveal_item(search_results[0])
-                get_app().invalidate()
+        @kb.add(None, None, Keys.Any, filter=in_search_mode)
+        def _(event):
+            if event.data.isprintable():
+                self.search(self.search_text + event.data)
 
-            inputs_dialog(callback, title="Enter a search", inputs_data=['Search'])
+        @kb.add(None, None, Keys.Backspace, filter=in_search_mode)
+        def _(event):
+            self.search(self.search_text[:-1])
 
         @kb.add('Next', 'Down', Keys.Down, filter=in_search_mode)
+        @kb.add(None, None, Keys.Enter, filter=in_search_mode)
         def _(event):
-            index = self.search_results.index(self.cursorItem)
-            index = (index + 1) % len(self.search_results)
-            self.reveal_item(self.search_results[index])
+            self.jump(1)
 
         @kb.add('Prev', 'Up', Keys.Up, filter=in_search_mode)
         def _(event):
-            index = self.search_results.index(self.cursorItem)
-            index = (index - 1) % len(self.search_results)
-            self.reveal_item(self.search_results[index])
+            self.jump(-1)
 
         @kb.add('Exit Search Mode', 'Esc', Keys.Escape, filter=in_search_mode)
         def _(event):
             self.search_mode = False
+            self.search_text = ''
             self.search_results = []
             get_app().invalidate()
 
@@ -303,6 +334,7 @@ class Tree(UIControl):
     def mouse_handler(self, mouse_event):
         return True
 
+    @timed('tree_render')
     def create_content(self, width, height):
         if self.dirty:
             self.refresh()
@@ -313,9 +345,18 @@ class Tree(UIControl):
         if cursor > height // 2:
             offset = height // 2 - cursor
 
+        status_lines = []
+        for indexer in self.indexers.values():
+            status_lines.append(' ' + indexer.status())
+        if self.search_mode:
+            found = '{}/{}'.format(self.search_position + 1, len(self.search_results)) if self.search_results \
+                else 'no match' if self.search_text else ''
+            status_lines.append(' Search: {}  {}'.format(self.search_text, found))
+
         def get_line(index):
-            if self.search_mode and index == height - 1:
-                return [('reverse', ' Search' + (' ' * (width - 7)))]
+            status = index - (height - len(status_lines))
+            if status >= 0:
+                return [('reverse', status_lines[status].ljust(width))]
 
             with_offset = index - offset
             if with_offset < 0 or with_offset >= len(self.indexes.keys()):
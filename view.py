@@ -0,0 +1,154 @@
+import numbers
+import operator
+import re
+from array import array
+from decimal import Decimal, InvalidOperation
+
+from store import cell_text
+
+FILTER_OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def sort_order(store, x):
+    """ Row indexes of `store` sorted by column `x`, nulls last. """
+    values = store.column_values(x)
+    rows = range(len(store))
+    try:
+        order = sorted(rows, key=lambda i: (values[i] is None, values[i]))
+    except TypeError:  # mixed types, compare the displayed text
+        order = sorted(rows, key=lambda i: (values[i] is None, cell_text(values[i])))
+    return array('Q', order)
+
+
+def parse_filter(text):
+    """
+    Predicate on a cell value from a filter text:
+    `> 10`, `= open`, `!= 3`, `is null`, `is not null`, or `abc` (contains).
+    Numbers, decimals included, are compared as numbers:
+
+    >>> parse_filter('> 10')(Decimal('9.5')), parse_filter('= 0.1')(Decimal('0.10'))
+    (False, True)
+    """
+    text = text.strip()
+    lower = text.lower()
+    if lower == 'is null':
+        return lambda value: value is None
+    if lower == 'is not null':
+        return lambda value: value is not None
+
+    match = re.match(r'^(<=|>=|!=|<>|=|<|>)\s*(.*)$', text)
+    if not match:
+        needle = text.lower()
+        return lambda value: value is not None and needle in cell_text(value).lower()
+
+    compare = FILTER_OPERATORS[match.group(1)]
+    operand = match.group(2)
+    try:
+        number = float(operand)
+        # exact for decimal columns: Decimal('0.1') != 0.1
+        decimal = Decimal(operand.strip())
+    except (ValueError, InvalidOperation):
+        number = None
+
+    def predicate(value):
+        if value is None:
+            return False
+        if number is not None:
+            if isinstance(value, Decimal):
+                try:
+                    return compare(value, decimal)
+                except InvalidOperation:  # NaN
+                    return False
+            if isinstance(value, numbers.Real) and not isinstance(value, bool):
+                return compare(value, number)
+        return compare(cell_text(value), operand)
+
+    return predicate
+
+
+class RowView:
+    """
+    Sorted and filtered view over the rows of a result store.
+
+    The view only holds row indexes. Sort orders are cached per column, so
+    switching columns or direction does not sort again. With `reverse`, the
+    store rows are shown from the last one (results read from their end).
+    """
+
+    def __init__(self, store, reverse=False):
+        self.store = store
+        self.reverse = reverse
+        self.sort_column = None
+        self.descending = False
+        self.filter = None
+        self.filter_text = None
+        self.orders = {}
+        self.rows = None
+        self.length = len(store)
+
+    def __len__(self):
+        if self.rows is None:
+            return len(self.store)
+        return len(self.rows)
+
+    def is_identity(self):
+        return self.sort_column is None and self.filter is None
+
+    def index(self, y):
+        """ Store row of the `y`-th row of the view. """
+        if self.rows is None:
+            return len(self.store) - 1 - y if self.reverse else y
+        if self.descending:
+            return self.rows[len(self.rows) - 1 - y]
+        return self.rows[y]
+
+    def order(self, x):
+        order = self.orders.get(x)
+        if order is None:
+            order = self.orders[x] = sort_order(self.store, x)
+        return order
+
+    def sort(self, x, descending=False):
+        self.sort_column = x
+        self.descending = descending and x is not None
+        self.build()
+
+    def set_filter(self, x, text):
+        if text is None or not text.strip():
+            self.filter = None
+            self.filter_text = None
+        else:
+            self.filter = (x, parse_filter(text))
+            self.filter_text = text.strip()
+        self.build()
+
+    def refresh(self):
+        """ Rows were appended to the store: cached orders are stale. """
+        if len(self.store) != self.length:
+            self.orders = {}
+            self.build()
+
+    def build(self):
+        self.length = len(self.store)
+        if self.sort_column is None and self.filter is None:
+            self.rows = None
+            return
+
+        rows = self.order(self.sort_column) if self.sort_column is not None else None
+        if self.filter is not None:
+            x, predicate = self.filter
+            values = self.store.column_values(x)
+            if rows is not None:
+                source = rows
+            else:
+                source = range(self.length - 1, -1, -1) if self.reverse else range(self.length)
+            rows = array('Q', (i for i in source if predicate(values[i])))
+        self.rows = rows
@@ -0,0 +1,148 @@
+import asyncio
+
+from prompt_toolkit.application import get_app
+
+from metrics import REGISTRY
+from worker import EXECUTOR
+
+# seconds between two checks of the catalog of a server, unless `watch_interval` is set (0 disables them)
+WATCH_INTERVAL = 30
+
+
+class SchemaWatcher:
+    """
+    Checks the catalog of a server in the background. Each loaded node with
+    a `fingerprint` query (rows of child name, fingerprint) is polled, and
+    only the nodes whose list of children changed, or the children whose
+    fingerprint changed, are queried again. Queries run in the executor, on
+    connections of the watcher; the tree is only updated from the cache.
+    """
+
+    def __init__(self, server_item, on_status):
+        self.server_item = server_item
+        self.on_status = on_status
+        self.interval = float(server_item.getRoot().dsn.get('watch_interval', WATCH_INTERVAL))
+        # fingerprints and connections by node path: nodes created again by a refresh keep them
+        self.fingerprints = {}
+        self.connections = {}
+
+    def start(self):
+        if self.interval > 0:
+            get_app().create_background_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception:
+                # a node removed meanwhile...: the next check starts over
+                dsn = self.server_item.getRoot().dsn
+                REGISTRY.inc('tree_watch_errors', server=dsn['host'] + ':' + dsn['port'])
+
+    async def check(self):
+        loop = asyncio.get_running_loop()
+        items = self.watched_items()
+        if not items:
+            return
+        try:
+            fingerprints = await loop.run_in_executor(EXECUTOR, self.poll, items)
+            changes = self.changes(fingerprints)
+            reloaded = self.invalidate(changes)
+            await loop.run_in_executor(EXECUTOR, self.fetch, reloaded)
+        except Exception:
+            self.close()
+            self.on_status(self.server_item, False)
+            return
+        self.on_status(self.server_item, True)
+        # kept once the changed nodes are cached again: a failed check is done again
+        for item, fingerprint in fingerprints:
+            self.fingerprints[item.path()] = fingerprint
+        for item, _ in changes:
+            item.reload()
+        self.server_item.tree.dirty = True
+        get_app().invalidate()
+
+    def watched_items(self):
+        items = []
+        pending = [self.server_item]
+        while pending:
+            item = pending.pop()
+            if hasattr(item, 'node_data') and item.children:
+                if 'fingerprint' in item.node_data:
+                    items.append(item)
+                pending.extend(item.children)
+        return items
+
+    def connection(self, conn_type, item):
+        # by path: a refresh replaces the owner node with a new one
+        key = item.parents[conn_type].path()
+        if key not in self.connections:
+            self.connections[key] = self.server_item.getRoot().driver.open_connection(conn_type, item.parents)
+        return key, self.connections[key]
+
+    def poll(self, items):
+        """ Fingerprints of the items, read on connections of this watcher. """
+        fingerprints = []
+        used = set()
+        for item in items:
+            key, conn = self.connection(item.node_data['fingerprint'][0], item)
+            used.add(key)
+            fingerprints.append((item, item.query_fingerprint(conn)))
+        # owners gone from the tree (a dropped database)
+        for key in set(self.connections) - used:
+            close(self.connections.pop(key))
+        return fingerprints
+
+    def changes(self, fingerprints):
+        """ Nodes to query again: (item, with its descendants). """
+        changes = []
+        for item, fingerprint in fingerprints:
+            old = self.fingerprints.get(item.path())
+            if old is None or old == fingerprint:
+                continue
+
+            list_changed = set(old) != set(fingerprint)
+            for child in item.children:
+                name = str(child.data[0]) if isinstance(getattr(child, 'data', None), tuple) else None
+                if name in old and name in fingerprint and old[name] != fingerprint[name]:
+                    if 'children_query' in child.node_data:
+                        changes.append((child, True))
+                    else:
+                        # nothing below it: the change shows in its label
+                        list_changed = True
+            if list_changed:
+                changes.append((item, False))
+        return changes
+
+    def invalidate(self, changes):
+        """ Drop the cached children of the changes, returns the nodes their reload shows again. """
+        items = []
+        for item, recursive in changes:
+            item.invalidate(recursive)
+            # open descendants are refreshed with it
+            pending = [item]
+            while pending:
+                node = pending.pop()
+                if 'children_query' in node.node_data:
+                    items.append(node)
+                pending.extend(child for child in node.children if child.isOpen and hasattr(child, 'node_data'))
+        return items
+
+    def fetch(self, items):
+        """ Query the children of the items into the cache (unless they are fresh), as the reloads read them. """
+        for item in items:
+            _, conn = self.connection(item.node_data['children_query'][0], item)
+            item.fetch_children(conn)
+
+    def close(self):
+        for conn in self.connections.values():
+            close(conn)
+        self.connections = {}
+
+
+def close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
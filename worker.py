@@ -0,0 +1,132 @@
+import asyncio
+from collections import deque
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from time import time
+
+from prompt_toolkit.application import get_app
+
+EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='sqltui')
+
+# jobs of each `serial` key (a connection), the first one is running
+SERIAL_JOBS = {}
+
+
+def call_in_ui(app, func, *args):
+    loop = getattr(app, 'loop', None)
+    if loop is None or not loop.is_running():
+        func(*args)
+    else:
+        loop.call_soon_threadsafe(func, *args)
+
+
+def run_in_background(func, done=None, error=None, executor=EXECUTOR):
+    app = get_app()
+
+    def run():
+        try:
+            result = func()
+        except Exception as e:
+            if error:
+                call_in_ui(app, error, e)
+            return
+        if done:
+            call_in_ui(app, done, result)
+
+    return executor.submit(run)
+
+
+class Job:
+    """
+    A cancellable background task, invalidating the app while it runs.
+    Jobs created with the same `serial` key (a connection) run one at a time:
+    a job starts once the previous one has finished, and its cancellation too.
+    """
+
+    def __init__(self, func, done=None, error=None, cancel=None, on_tick=None, tick=0.2, serial=None):
+        self.started = time()
+        self.finished = False
+        self.cancelled = False
+        self.cancelling = False
+        self.func = func
+        self.done_callback = done
+        self.error_callback = error
+        self.cancel_callback = cancel
+        self.on_tick = on_tick
+        self.tick = tick
+        self.serial = serial
+        self.future = None
+
+        if serial is None:
+            self.start()
+        else:
+            queue = SERIAL_JOBS.setdefault(serial, deque())
+            queue.append(self)
+            if len(queue) == 1:
+                self.start()
+
+        app = get_app()
+        if getattr(app, 'loop', None) is not None and app.is_running:
+            app.create_background_task(self.ticker())
+
+    def start(self):
+        if self.cancelled:
+            # cancelled while waiting for its turn
+            self.on_error(CancelledError())
+            return
+        self.started = time()
+        self.future = run_in_background(self.func, self.on_done, self.on_error)
+
+    def on_done(self, result):
+        self.finished = True
+        if self.cancelled:
+            # nobody will read it, closing it can take a while (rows left to read)
+            if hasattr(result, 'close'):
+                Job(result.close, serial=self.serial)
+            if self.error_callback:
+                self.error_callback(CancelledError())
+        elif self.done_callback:
+            self.done_callback(result)
+        self.settle()
+        get_app().invalidate()
+
+    def on_error(self, e):
+        self.finished = True
+        if self.error_callback:
+            self.error_callback(e)
+        self.settle()
+        get_app().invalidate()
+
+    def settle(self):
+        """ Start the next job of the same key, once this one and its cancellation are over. """
+        if self.serial is None or not self.finished or self.cancelling:
+            return
+        queue = SERIAL_JOBS.get(self.serial)
+        if not queue or queue[0] is not self:
+            return
+        queue.popleft()
+        if queue:
+            queue[0].start()
+        else:
+            del SERIAL_JOBS[self.serial]
+
+    def elapsed(self):
+        return time() - self.started
+
+    def cancel(self):
+        if self.finished or self.cancelled:
+            return
+        self.cancelled = True
+        if self.cancel_callback and self.future is not None:
+            self.cancelling = True
+            run_in_background(self.cancel_callback, self.cancelled_callback, self.cancelled_callback)
+
+    def cancelled_callback(self, result=None):
+        self.cancelling = False
+        self.settle()
+
+    async def ticker(self):
+        while not self.finished:
+            if self.on_tick and not self.cancelled:
+                self.on_tick(self)
+            get_app().invalidate()
+            await asyncio.sleep(self.tick)